@@ -0,0 +1,73 @@
+"""
+DB HELPER MICRO-BENCHMARK
+Compares helper latency with a fresh connection per call (old get_db)
+against the persistent WAL connection used by main.get_db.
+
+Usage: python bench_db.py [iterations]
+"""
+
+import os
+import sys
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+
+import main
+
+
+@contextmanager
+def legacy_get_db():
+    conn = sqlite3.connect(main.DB_FILE)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def run_helpers(n: int):
+    token = "123456:BENCH"
+    main.save_user(1, "bench", "Bench")
+    main.save_bot(1, token, "bench.py", "upload", "bench_bot")
+    timings = {}
+    for name, call in (
+        ("save_user", lambda i: main.save_user(i % 100, "bench", "Bench")),
+        ("update_bot_status", lambda i: main.update_bot_status(token, "running")),
+        ("get_user_bots", lambda i: main.get_user_bots(1)),
+        ("get_stats", lambda i: main.get_stats()),
+    ):
+        start = time.perf_counter()
+        for i in range(n):
+            call(i)
+        timings[name] = (time.perf_counter() - start) / n * 1e6
+    return timings
+
+
+def main_bench():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DB_FILE = os.path.join(tmp, "legacy.db")
+        pooled_get_db = main.get_db
+        main.get_db = legacy_get_db
+        # Legacy mode also used the default rollback journal
+        with legacy_get_db() as conn:
+            conn.execute("PRAGMA journal_mode=DELETE")
+        main.init_db()
+        before = run_helpers(n)
+
+        main.get_db = pooled_get_db
+        main.close_db()
+        main.DB_FILE = os.path.join(tmp, "pooled.db")
+        main.init_db()
+        after = run_helpers(n)
+        main.close_db()
+
+    print(f"{'helper':<20}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    for name in before:
+        print(f"{name:<20}{before[name]:>14.1f}{after[name]:>14.1f}{before[name] / after[name]:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,327 @@
+"""
+LOAD-TEST HARNESS
+Runs the platform against a local stand-in for the Telegram Bot API: starts
+N synthetic echo bots through main.start_user_bot, fires updates at the
+aiohttp /bot/{token} route (or queues them for the poll multiplexer with
+--mode polling) and reports throughput, latency, DB write rate and RSS.
+
+Latency is measured twice: "ack" is the webhook POST round trip, "e2e" runs
+from sending an update until the bot's sendMessage reply reaches the fake API.
+The fake API and the traffic generator share the platform's event loop, so
+absolute numbers are pessimistic; compare runs against a saved --baseline.
+
+Usage: python bench_load.py [--bots 20] [--updates 5000] [--concurrency 50]
+                            [--rate 0] [--mode webhook|polling]
+                            [--execution inprocess|process] [--workers 2]
+                            [--json result.json] [--baseline result.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web, ClientSession
+
+import main
+
+# Custom bot_data type: with BOT_PERSISTENCE=1 the persistence must hand back
+# a BotData, not a dict, or Application.initialize() refuses to start the bot
+BOT_TEMPLATE = '''
+from telegram.ext import Application, ContextTypes, MessageHandler, filters
+
+class BotData:
+    def __init__(self):
+        self.echoed = 0
+
+async def echo(update, context):
+    context.bot_data.echoed += 1
+    await update.message.reply_text(update.message.text)
+
+context_types = ContextTypes(bot_data=BotData)
+application = Application.builder().token({token!r}).base_url({base_url!r}).context_types(context_types).build()
+application.add_handler(MessageHandler(filters.TEXT, echo))
+'''
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def make_update(seq: int) -> dict:
+    return {
+        "update_id": seq,
+        "message": {
+            "message_id": seq, "date": int(time.time()), "text": f"ping {seq}",
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Load"},
+        },
+    }
+
+
+class FakeTelegram:
+    # Enough of the Bot API for hosted echo bots: getMe, (set|delete)Webhook,
+    # getUpdates with long polling, and sendMessage, which timestamps replies
+    def __init__(self):
+        self.calls = Counter()
+        self.sent_at = {}
+        self.e2e = []
+        self.replies = 0
+        self.queues = defaultdict(list)
+        self.events = defaultdict(asyncio.Event)
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    async def handle(self, request):
+        token, method = request.match_info["token"], request.match_info["method"]
+        self.calls[method] += 1
+        params = dict(request.query)
+        if request.content_type == "application/json":
+            params.update(await request.json())
+        elif request.can_read_body:
+            params.update(await request.post())
+        bot_id = int(token.split(":")[0])
+        if method == "getMe":
+            result = {"id": bot_id, "is_bot": True, "first_name": "Load", "username": f"load{bot_id}_bot"}
+        elif method == "sendMessage":
+            text = str(params.get("text", ""))
+            seq = int(text.split()[-1]) if text.startswith("ping ") else None
+            if seq in self.sent_at:
+                self.e2e.append(time.perf_counter() - self.sent_at.pop(seq))
+            self.replies += 1
+            if self.replies >= self.expected:
+                self.done.set()
+            result = {"message_id": 1, "date": int(time.time()), "chat": {"id": 1, "type": "private"}, "text": text}
+        elif method == "getUpdates":
+            result = await self.get_updates(token, int(params.get("offset", 0)), int(params.get("timeout", 0)))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def get_updates(self, token: str, offset: int, timeout: int):
+        queue = self.queues[token]
+        queue[:] = [u for u in queue if u["update_id"] >= offset]
+        if not queue and timeout:
+            event = self.events[token]
+            event.clear()
+            try: await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError: pass
+        return queue[:100]
+
+    def enqueue(self, token: str, update: dict):
+        self.queues[token].append(update)
+        self.events[token].set()
+
+    async def start(self, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+
+async def load_bots(n: int, base_url: str, concurrency: int):
+    slots = asyncio.Semaphore(concurrency)
+    tokens = [f"{7000000 + i}:LOAD{i:06d}" for i in range(n)]
+    main.save_user(1, "load", "Load")
+
+    async def load(token: str):
+        path = os.path.join(main.BOTS_DIR, f"load_{token.split(':')[0]}.py")
+        with open(path, "w") as f:
+            f.write(BOT_TEMPLATE.format(token=token, base_url=base_url))
+        main.save_bot(1, token, path, "upload", f"load{token.split(':')[0]}_bot")
+        async with slots:
+            ok, msg = await main.start_user_bot(token, path)
+        if not ok:
+            raise RuntimeError(f"{token}: {msg}")
+
+    await asyncio.gather(*(load(t) for t in tokens))
+    return tokens
+
+
+async def drive_traffic(args, fake: FakeTelegram, tokens, platform_url: str):
+    ack, statuses = [], Counter()
+    limiter = main.RateLimiter(args.rate, burst=args.concurrency) if args.rate else None
+    seqs = iter(range(1, args.updates + 1))
+
+    async def sender(session: ClientSession):
+        for seq in seqs:
+            if limiter:
+                await limiter.acquire()
+            token = tokens[seq % len(tokens)]
+            update = make_update(seq)
+            fake.sent_at[seq] = time.perf_counter()
+            if args.mode == "polling":
+                fake.enqueue(token, update)
+                continue
+            while True:
+                started = time.perf_counter()
+                async with session.post(f"{platform_url}/bot/{token}", json=update) as resp:
+                    await resp.read()
+                ack.append(time.perf_counter() - started)
+                statuses[resp.status] += 1
+                if resp.status != 503:
+                    break
+                # Queue full: back off like Telegram's redelivery would
+                await asyncio.sleep(0.05)
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(sender(session) for _ in range(args.concurrency)))
+    return ack, statuses
+
+
+async def run(args):
+    fake_port, platform_port = free_port(), free_port()
+    base = f"http://127.0.0.1:{fake_port}"
+    # Worker processes read these at import
+    os.environ["TELEGRAM_API_URL"] = main.TELEGRAM_API_URL = base
+    os.environ["INGESTION_MODE"] = main.INGESTION_MODE = args.mode
+
+    fake = FakeTelegram()
+    fake_runner = await fake.start(fake_port)
+    main.init_db()
+    main.get_http_session()
+    writes = Counter()
+    db_write = main.db.write
+
+    async def counted_write(fn, *a):
+        writes[fn.__name__] += 1
+        return await db_write(fn, *a)
+
+    main.db.write = counted_write
+
+    if args.execution == "process":
+        main.WORKER_POOL = main.WorkerPool(args.workers)
+        await main.WORKER_POOL.start()
+    if args.mode == "polling":
+        main.POLLER = main.PollMultiplexer()
+        main.POLLER.start()
+    server = web.AppRunner(main.build_web_app())
+    await server.setup()
+    await web.TCPSite(server, "127.0.0.1", platform_port).start()
+    flusher = asyncio.create_task(main.update_count_flusher())
+
+    rss_base = main.process_rss()
+    started = time.perf_counter()
+    tokens = await load_bots(args.bots, f"{base}/bot", args.load_concurrency)
+    load_time = time.perf_counter() - started
+    rss_loaded = main.process_rss()
+
+    fake.expected = args.updates
+    writes.clear()
+    started = time.perf_counter()
+    ack, statuses = await drive_traffic(args, fake, tokens, f"http://127.0.0.1:{platform_port}")
+    sent = time.perf_counter() - started
+    try: await asyncio.wait_for(fake.done.wait(), timeout=args.drain_timeout)
+    except asyncio.TimeoutError: pass
+    elapsed = time.perf_counter() - started
+    await main.flush_update_counts()
+    rss_peak = main.process_rss()
+    if main.WORKER_POOL:
+        rss_peak += sum(main.process_rss(s.process.pid) for s in main.WORKER_POOL.shards)
+
+    result = {
+        "bots": args.bots, "updates": args.updates, "concurrency": args.concurrency,
+        "mode": args.mode, "execution": args.execution,
+        "load_seconds": round(load_time, 3),
+        "completed": len(fake.e2e),
+        "throughput": round(len(fake.e2e) / elapsed, 1),
+        "send_seconds": round(sent, 3),
+        "ack_p50_ms": round(percentile(ack, 0.5) * 1000, 2),
+        "ack_p99_ms": round(percentile(ack, 0.99) * 1000, 2),
+        "e2e_p50_ms": round(percentile(fake.e2e, 0.5) * 1000, 2),
+        "e2e_p99_ms": round(percentile(fake.e2e, 0.99) * 1000, 2),
+        "rejected": statuses.get(503, 0),
+        "db_writes": sum(writes.values()),
+        "db_writes_per_s": round(sum(writes.values()) / elapsed, 1),
+        "rss_base_mb": round(rss_base / 2 ** 20, 1),
+        "rss_loaded_mb": round(rss_loaded / 2 ** 20, 1),
+        "rss_peak_mb": round(rss_peak / 2 ** 20, 1),
+    }
+
+    flusher.cancel()
+    await server.cleanup()
+    for token in tokens:
+        await main.stop_user_bot(token)
+    await main.shutdown_platform()
+    await fake_runner.cleanup()
+    return result
+
+
+def report(result: dict, baseline: dict = None):
+    per_bot = (result["rss_loaded_mb"] - result["rss_base_mb"]) / max(result["bots"], 1)
+    print(f"bots        {result['bots']} loaded in {result['load_seconds']:.2f}s "
+          f"({result['mode']}, {result['execution']})")
+    print(f"updates     {result['completed']}/{result['updates']} answered, concurrency {result['concurrency']}")
+    print(f"rejected    {result['rejected']} (503, retried)")
+    print(f"rss         base {result['rss_base_mb']} MB, loaded {result['rss_loaded_mb']} MB "
+          f"({per_bot:.2f} MB/bot), peak {result['rss_peak_mb']} MB")
+    print()
+    keys = ("throughput", "ack_p50_ms", "ack_p99_ms", "e2e_p50_ms", "e2e_p99_ms", "db_writes_per_s", "rss_peak_mb")
+    header = f"{'metric':<18}{'value':>12}"
+    if baseline:
+        header += f"{'baseline':>12}{'change':>10}"
+    print(header)
+    for key in keys:
+        line = f"{key:<18}{result[key]:>12}"
+        if baseline and key in baseline:
+            before = baseline[key]
+            change = f"{(result[key] - before) / before:+.1%}" if before else "n/a"
+            line += f"{before:>12}{change:>10}"
+        print(line)
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Load-test the hosting platform against a fake Bot API")
+    parser.add_argument("--bots", type=int, default=20)
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent webhook senders")
+    parser.add_argument("--rate", type=float, default=0, help="cap on updates/s (0 = as fast as possible)")
+    parser.add_argument("--mode", choices=("webhook", "polling"), default="webhook")
+    parser.add_argument("--execution", choices=("inprocess", "process"), default="inprocess")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--load-concurrency", type=int, default=8)
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--json", help="write the result to this file")
+    parser.add_argument("--baseline", help="compare against a previous --json result")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # DB, bot files and analysis cache are relative paths; keep them out of the repo
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        os.makedirs(main.BOTS_DIR, exist_ok=True)
+        try:
+            result = asyncio.run(run(args))
+        finally:
+            os.chdir(cwd)
+
+    report(result, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -11,16 +11,42 @@ import sys
 import asyncio
 import importlib.util
 import importlib.metadata
-import subprocess
 import ast
 import re
 import time
 import html
 import json
+import itertools
+import bisect
+import contextvars
+import cProfile
+import pstats
+import gc
+import tracemalloc
+import marshal
+import pickle
+import hashlib
+import functools
+import signal
+import threading
+import weakref
+import struct
+import zlib
+import shutil
+import tempfile
+import multiprocessing
 from datetime import datetime
-from contextlib import contextmanager
-from typing import Optional, Tuple, Dict, List, Any
-from io import BytesIO
+from contextlib import contextmanager, asynccontextmanager
+from typing import Optional, Tuple, Dict, List, Any, NamedTuple
+from types import CodeType
+from io import BytesIO, StringIO
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # ==========================================
 # SAFE IMPORT FOR DOTENV
@@ -31,17 +57,20 @@ try:
 except ImportError:
     def load_dotenv(): pass
 
-from aiohttp import web, ClientSession, ClientTimeout
+from aiohttp import web, ClientSession, ClientTimeout, ClientError, FormData, TCPConnector
 from telegram import (
+    __version__ as PTB_VERSION,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove
 )
-from telegram.request import HTTPXRequest
+from telegram.request import HTTPXRequest, BaseRequest, RequestData
 from telegram.ext import (
     Application,
+    ApplicationBuilder,
+    BasePersistence,
     CommandHandler,
     MessageHandler,
     ContextTypes,
@@ -49,7 +78,8 @@ from telegram.ext import (
     ConversationHandler,
     CallbackQueryHandler,
 )
-from telegram.error import Forbidden, BadRequest
+from telegram.error import Forbidden, BadRequest, RetryAfter, TimedOut, NetworkError
+from telegram._utils.defaultvalue import DefaultValue
 
 # ==========================================
 # CONFIGURATION
@@ -64,6 +94,9 @@ PLATFORM_BOT_TOKEN = "8066184862:AAGxPAHFcwQAmEt9fsAuyZG8DUPt8A-01fY"
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 RENDER_EXTERNAL_URL = os.getenv("RENDER_EXTERNAL_URL", "https://hostkaro.onrender.com")
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:streamGenerateContent?alt=sse"
+# Bot API endpoint; point at a local stand-in for load tests (see bench_load.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
 
 # Startup Verification
 if not GEMINI_API_KEY:
@@ -84,10 +117,155 @@ logger = logging.getLogger(__name__)
 # GLOBAL STATE
 # ==========================================
 ACTIVE_BOTS: Dict[str, Application] = {}
+DORMANT_BOTS: Dict[str, str] = {}  # token -> file_path; webhook registered, code not loaded (LAZY_ACTIVATION)
+RESTORING_BOTS: Dict[str, str] = {}  # token -> file_path; queued for startup restore, webhooks answered 503
+BOT_MODULES: Dict[str, str] = {}  # token -> sys.modules name of the loaded bot code
+BOT_MEMORY: Dict[str, Dict[str, Any]] = {}  # token -> file path and RSS growth at load
 DB_FILE = "bot_platform.db"
 BOTS_DIR = "user_bots"
 platform_app: Optional[Application] = None
 
+# Database connections
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "128"))
+DB_READ_THREADS = int(os.getenv("DB_READ_THREADS", "4"))
+
+# Dependency installer
+INSTALL_CONCURRENCY = int(os.getenv("INSTALL_CONCURRENCY", "2"))
+INSTALL_TIMEOUT = float(os.getenv("INSTALL_TIMEOUT", "120"))
+INSTALL_RETRY_AFTER = float(os.getenv("INSTALL_RETRY_AFTER", "600"))
+
+# Startup restore
+RESTORE_CONCURRENCY = int(os.getenv("RESTORE_CONCURRENCY", "8"))
+RESTORE_RATE = float(os.getenv("RESTORE_RATE", "10"))
+
+# Update dispatch: per-bot bounded queues. Overflow policy is one of
+# "reject" (answer 503 so Telegram redelivers), "drop_oldest" or "drop_newest"
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "100"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "4"))
+PLATFORM_UPDATE_WORKERS = int(os.getenv("PLATFORM_UPDATE_WORKERS", "16"))
+UPDATE_OVERFLOW_POLICY = os.getenv("UPDATE_OVERFLOW_POLICY", "reject")
+STOP_DRAIN_TIMEOUT = float(os.getenv("STOP_DRAIN_TIMEOUT", "5"))
+# Recently accepted update_ids remembered per bot to drop Telegram redeliveries (0 = off)
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "512"))
+
+# Metrics: GET /metrics in Prometheus text format. Set METRICS_TOKEN to
+# require it as a bearer token (or ?token=) on the endpoint
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+METRICS_SHARD_TIMEOUT = float(os.getenv("METRICS_SHARD_TIMEOUT", "2"))  # process mode: wait for each shard's per-bot series
+
+# Profiling: updates slower than SLOW_UPDATE_THRESHOLD are kept for the
+# admin profile report, which samples the loop with cProfile for PROFILE_SECONDS
+SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", "1"))
+SLOW_UPDATE_HISTORY = int(os.getenv("SLOW_UPDATE_HISTORY", "50"))
+PROFILE_SECONDS = float(os.getenv("PROFILE_SECONDS", "10"))
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "40"))
+
+# Fair scheduling for hosted bots: global concurrency cap, slow handler
+# detection and loop-time budget (fraction of each window) before throttling
+SCHED_MAX_CONCURRENT = int(os.getenv("SCHED_MAX_CONCURRENT", "64"))
+SLOW_CALLBACK_THRESHOLD = float(os.getenv("SLOW_CALLBACK_THRESHOLD", "0.25"))
+SCHED_WINDOW = float(os.getenv("SCHED_WINDOW", "10"))
+SCHED_BUSY_BUDGET = float(os.getenv("SCHED_BUSY_BUDGET", "0.2"))
+SCHED_THROTTLE_SECONDS = float(os.getenv("SCHED_THROTTLE_SECONDS", "5"))
+
+# Execution mode: "inprocess" runs every hosted bot on the platform loop,
+# "process" shards them across WORKER_PROCESSES worker processes
+EXECUTION_MODE = os.getenv("EXECUTION_MODE", "inprocess")
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", str(os.cpu_count() or 1)))
+WORKER_START_TIMEOUT = int(os.getenv("WORKER_START_TIMEOUT", "30"))
+WORKER_MAX_BACKLOG = int(os.getenv("WORKER_MAX_BACKLOG", str(8 * 1024 * 1024)))
+
+# Ingestion: "webhook" (Telegram posts to RENDER_EXTERNAL_URL/bot/{token}) or
+# "polling" (one multiplexer long-polls getUpdates for every bot). Polls in
+# flight adapt between POLL_MIN_CONCURRENCY and POLL_MAX_CONCURRENCY
+INGESTION_MODE = os.getenv("INGESTION_MODE", "webhook")
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "25"))
+POLL_MIN_CONCURRENCY = int(os.getenv("POLL_MIN_CONCURRENCY", "10"))
+POLL_MAX_CONCURRENCY = int(os.getenv("POLL_MAX_CONCURRENCY", "200"))
+POLL_IDLE_MAX_DELAY = float(os.getenv("POLL_IDLE_MAX_DELAY", "10"))
+
+# Shared outbound HTTP connection pool
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "20"))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "60"))
+
+# Hosted bots' Bot API calls share one keep-alive pool of SHARED_POOL_SIZE
+# connections. Message-sending calls are limited per bot and globally
+# (0 = unlimited), and 429s up to RETRY_AFTER_MAX seconds are retried
+SHARED_BOT_REQUESTS = os.getenv("SHARED_BOT_REQUESTS", "1") == "1"
+SHARED_POOL_SIZE = int(os.getenv("SHARED_POOL_SIZE", "128"))
+SHARED_POOL_TIMEOUT = float(os.getenv("SHARED_POOL_TIMEOUT", "10"))
+BOT_SEND_RATE = float(os.getenv("BOT_SEND_RATE", "30"))
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", "0"))
+RETRY_AFTER_MAX = float(os.getenv("RETRY_AFTER_MAX", "30"))
+RETRY_AFTER_ATTEMPTS = int(os.getenv("RETRY_AFTER_ATTEMPTS", "3"))
+
+# Bot token validation cache
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1024"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "600"))
+TOKEN_NEGATIVE_TTL = float(os.getenv("TOKEN_NEGATIVE_TTL", "60"))
+
+# Broadcasts: Telegram allows roughly 30 messages/second per bot overall
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "500"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+
+# Gemini consultation response cache (persisted in SQLite)
+GEMINI_CACHE_TTL = float(os.getenv("GEMINI_CACHE_TTL", str(7 * 24 * 3600)))
+GEMINI_CACHE_SIZE = int(os.getenv("GEMINI_CACHE_SIZE", "5000"))
+
+# Code generation streaming and status message refresh interval
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "1") == "1"
+BUILD_PROGRESS_INTERVAL = float(os.getenv("BUILD_PROGRESS_INTERVAL", "2"))
+
+# Parsed/compiled bot file cache
+ANALYSIS_CACHE_DIR = os.path.join(BOTS_DIR, ".analysis")
+ANALYSIS_MEMO_SIZE = int(os.getenv("ANALYSIS_MEMO_SIZE", "256"))
+ANALYSIS_MEMO_TTL = float(os.getenv("ANALYSIS_MEMO_TTL", "3600"))
+ANALYSIS_CACHE_MAX_FILES = int(os.getenv("ANALYSIS_CACHE_MAX_FILES", "2000"))
+
+# Memory accounting: TRACE_MALLOC=1 enables tracemalloc with TRACE_FRAMES
+# frames per allocation, so memory can be attributed to each bot's file
+TRACE_MALLOC = os.getenv("TRACE_MALLOC", "0") == "1"
+TRACE_FRAMES = int(os.getenv("TRACE_FRAMES", "10"))
+
+# Lazy activation: restored bots load on their first update and are evicted
+# after IDLE_EVICT_SECONDS without updates, or least recently used first
+# once more than LAZY_MAX_ACTIVE are loaded (0 = no cap)
+LAZY_ACTIVATION = os.getenv("LAZY_ACTIVATION", "0") == "1"
+IDLE_EVICT_SECONDS = float(os.getenv("IDLE_EVICT_SECONDS", "3600"))
+LAZY_MAX_ACTIVE = int(os.getenv("LAZY_MAX_ACTIVE", "0"))
+EVICT_CHECK_INTERVAL = float(os.getenv("EVICT_CHECK_INTERVAL", "60"))
+# Unloaded bot modules are reclaimed by one gc.collect() this many seconds
+# after an unload, covering every other unload in between
+UNLOAD_GC_DELAY = float(os.getenv("UNLOAD_GC_DELAY", "1"))
+
+# Update counters (write-behind)
+PENDING_UPDATE_COUNTS: Dict[str, int] = {}
+UPDATE_FLUSH_INTERVAL = float(os.getenv("UPDATE_FLUSH_INTERVAL", "5"))
+UPDATE_FLUSH_THRESHOLD = int(os.getenv("UPDATE_FLUSH_THRESHOLD", "500"))
+
+# Hosted bot persistence (user/chat/bot data, conversations) in SQLite: PTB
+# hands over changed keys every PERSISTENCE_UPDATE_INTERVAL, and all bots'
+# changes are written in one batch every PERSISTENCE_FLUSH_INTERVAL. Opt-in:
+# PTB deep-copies bot/user/chat data for it, which fails for bots keeping
+# clients, locks or open files there
+BOT_PERSISTENCE = os.getenv("BOT_PERSISTENCE", "0") == "1"
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "10"))
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "5"))
+_pending_update_total = 0
+_update_flush_wakeup = asyncio.Event()
+FLUSHING_UPDATE_COUNTS: Dict[str, int] = {}  # deltas handed to the DB writer, not yet committed
+
+_db_local = threading.local()
+_db_conns: List[sqlite3.Connection] = []
+_db_conns_lock = threading.Lock()
+
 os.makedirs(BOTS_DIR, exist_ok=True)
 
 # ==========================================
@@ -109,52 +287,162 @@ os.makedirs(BOTS_DIR, exist_ok=True)
 # ==========================================
 # DATABASE
 # ==========================================
+def _connect_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_FILE,
+        timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_STATEMENT_CACHE,
+        check_same_thread=False
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+    return conn
+
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            joined_at TEXT,
-            last_active TEXT
-        )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS bots (
-            bot_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            token TEXT UNIQUE,
-            bot_username TEXT,
-            file_path TEXT,
-            status TEXT DEFAULT 'stopped',
-            creation_type TEXT,
-            created_at TEXT,
-            error_log TEXT,
-            is_blocked INTEGER DEFAULT 0,
-            update_count INTEGER DEFAULT 0,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-    """)
-    try: c.execute("SELECT is_blocked FROM bots LIMIT 1")
-    except: c.execute("ALTER TABLE bots ADD COLUMN is_blocked INTEGER DEFAULT 0")
-    try: c.execute("SELECT update_count FROM bots LIMIT 1")
-    except: c.execute("ALTER TABLE bots ADD COLUMN update_count INTEGER DEFAULT 0")
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                joined_at TEXT,
+                last_active TEXT
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS bots (
+                bot_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                token TEXT UNIQUE,
+                bot_username TEXT,
+                file_path TEXT,
+                status TEXT DEFAULT 'stopped',
+                creation_type TEXT,
+                created_at TEXT,
+                error_log TEXT,
+                is_blocked INTEGER DEFAULT 0,
+                update_count INTEGER DEFAULT 0,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        """)
+        try: c.execute("SELECT is_blocked FROM bots LIMIT 1")
+        except: c.execute("ALTER TABLE bots ADD COLUMN is_blocked INTEGER DEFAULT 0")
+        try: c.execute("SELECT update_count FROM bots LIMIT 1")
+        except: c.execute("ALTER TABLE bots ADD COLUMN update_count INTEGER DEFAULT 0")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_bots_user_id ON bots(user_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_bots_status ON bots(status)")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS bot_persistence (
+                tg_bot_id INTEGER,
+                kind TEXT,
+                key TEXT,
+                data BLOB,
+                PRIMARY KEY (tg_bot_id, kind, key)
+            ) WITHOUT ROWID
+        """)
+        # Keyed by the Telegram bot id (token prefix), not bots.bot_id
+        try: c.execute("SELECT tg_bot_id FROM bot_persistence LIMIT 1")
+        except: c.execute("ALTER TABLE bot_persistence RENAME COLUMN bot_id TO tg_bot_id")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS gemini_cache (
+                cache_key TEXT PRIMARY KEY,
+                response TEXT,
+                created_at REAL,
+                last_used REAL
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT,
+                total INTEGER,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'running',
+                started_at TEXT,
+                finished_at TEXT
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_results (
+                broadcast_id INTEGER,
+                user_id INTEGER,
+                status TEXT,
+                error TEXT,
+                PRIMARY KEY (broadcast_id, user_id)
+            )
+        """)
     logger.info("Database initialized")
 
 
 @contextmanager
 def get_db():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    # One long-lived connection per thread, reused by every helper
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = _connect_db()
+        _db_local.conn = conn
+        with _db_conns_lock:
+            _db_conns.append(conn)
     try:
         yield conn
         conn.commit()
-    finally:
-        conn.close()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def close_db():
+    with _db_conns_lock:
+        conns = list(_db_conns)
+        _db_conns.clear()
+    for conn in conns:
+        try: conn.close()
+        except Exception: pass
+    _db_local.__dict__.clear()
+
+
+# Bot row cache: bot_id -> row and token -> bot_id. Every helper that writes
+# to `bots` invalidates the affected entries; the generation counter stops a
+# reader from caching a row it fetched before a concurrent write committed.
+_BOT_ROWS: Dict[int, sqlite3.Row] = {}
+_BOT_IDS: Dict[str, int] = {}
+_bot_cache_lock = threading.Lock()
+_bot_cache_gen = 0
+
+
+def _invalidate_bots(*tokens: str, forget: bool = False):
+    global _bot_cache_gen
+    with _bot_cache_lock:
+        _bot_cache_gen += 1
+        for token in tokens:
+            bot_id = _BOT_IDS.pop(token, None) if forget else _BOT_IDS.get(token)
+            if bot_id is not None:
+                _BOT_ROWS.pop(bot_id, None)
+
+
+def _cache_bot(row: Optional[sqlite3.Row], gen: int):
+    if row is None:
+        return
+    with _bot_cache_lock:
+        if gen == _bot_cache_gen:
+            _BOT_ROWS[row['bot_id']] = row
+            _BOT_IDS[row['token']] = row['bot_id']
+
+
+def get_bot(bot_id: int) -> Optional[sqlite3.Row]:
+    row = _BOT_ROWS.get(bot_id)
+    if row is not None:
+        return row
+    gen = _bot_cache_gen
+    with get_db() as conn:
+        row = conn.execute("SELECT * FROM bots WHERE bot_id = ?", (bot_id,)).fetchone()
+    _cache_bot(row, gen)
+    return row
 
 
 def save_user(user_id: int, username: str, first_name: str):
@@ -182,6 +470,7 @@ def save_bot(user_id: int, token: str, file_path: str, creation_type: str, bot_u
                status = 'running'""",
             (user_id, token, bot_username, file_path, creation_type, now)
         )
+    _invalidate_bots(token)
 
 
 def get_user_bots(user_id: int):
@@ -200,11 +489,22 @@ def update_bot_status(token: str, status: str, error: str = None):
             conn.execute("UPDATE bots SET status = ?, error_log = ? WHERE token = ?", (status, error, token))
         else:
             conn.execute("UPDATE bots SET status = ? WHERE token = ?", (status, token))
+    _invalidate_bots(token)
 
 
-def increment_bot_update_count(token: str):
+def persist_update_counts(batch: List[Tuple[str, int]]):
     with get_db() as conn:
-        conn.execute("UPDATE bots SET update_count = update_count + 1 WHERE token = ?", (token,))
+        conn.executemany(
+            "UPDATE bots SET update_count = update_count + ? WHERE token = ?",
+            [(delta, token) for token, delta in batch]
+        )
+    _invalidate_bots(*(token for token, _ in batch))
+
+
+def set_bot_error(token: str, error: str):
+    with get_db() as conn:
+        conn.execute("UPDATE bots SET error_log = ? WHERE token = ?", (error, token))
+    _invalidate_bots(token)
 
 
 def toggle_bot_block(token: str) -> bool:
@@ -212,7 +512,8 @@ def toggle_bot_block(token: str) -> bool:
         current = conn.execute("SELECT is_blocked FROM bots WHERE token = ?", (token,)).fetchone()[0]
         new_status = 0 if current else 1
         conn.execute("UPDATE bots SET is_blocked = ? WHERE token = ?", (new_status, token))
-        return bool(new_status)
+    _invalidate_bots(token)
+    return bool(new_status)
 
 
 def get_all_running_bots():
@@ -223,6 +524,96 @@ def get_all_running_bots():
 def delete_bot_from_db(token: str):
     with get_db() as conn:
         conn.execute("DELETE FROM bots WHERE token = ?", (token,))
+        tg_bot_id = token.split(":", 1)[0]
+        if tg_bot_id.isdigit():
+            conn.execute("DELETE FROM bot_persistence WHERE tg_bot_id = ?", (int(tg_bot_id),))
+    _invalidate_bots(token, forget=True)
+
+
+def load_bot_state(tg_bot_id: int):
+    with get_db() as conn:
+        return conn.execute("SELECT kind, key, data FROM bot_persistence WHERE tg_bot_id = ?", (tg_bot_id,)).fetchall()
+
+
+def save_bot_state(batch: List[Tuple[int, str, str, Optional[bytes]]]):
+    # data None deletes the key; keys are unique within a batch
+    with get_db() as conn:
+        conn.executemany(
+            """INSERT INTO bot_persistence (tg_bot_id, kind, key, data) VALUES (?, ?, ?, ?)
+               ON CONFLICT(tg_bot_id, kind, key) DO UPDATE SET data = excluded.data""",
+            [row for row in batch if row[3] is not None]
+        )
+        conn.executemany(
+            "DELETE FROM bot_persistence WHERE tg_bot_id = ? AND kind = ? AND key = ?",
+            [row[:3] for row in batch if row[3] is None]
+        )
+
+
+def get_gemini_cache(cache_key: str) -> Optional[str]:
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT response FROM gemini_cache WHERE cache_key = ? AND created_at > ?",
+            (cache_key, time.time() - GEMINI_CACHE_TTL)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE gemini_cache SET last_used = ? WHERE cache_key = ?", (time.time(), cache_key))
+        return row[0]
+
+
+def put_gemini_cache(cache_key: str, response: str):
+    now = time.time()
+    with get_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO gemini_cache (cache_key, response, created_at, last_used) VALUES (?, ?, ?, ?)",
+            (cache_key, response, now, now)
+        )
+        # Evict expired entries, then the least recently used beyond the size cap
+        conn.execute("DELETE FROM gemini_cache WHERE created_at <= ?", (now - GEMINI_CACHE_TTL,))
+        conn.execute(
+            """DELETE FROM gemini_cache WHERE cache_key IN (
+                   SELECT cache_key FROM gemini_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)""",
+            (GEMINI_CACHE_SIZE,)
+        )
+
+
+def count_users() -> int:
+    with get_db() as conn:
+        return conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+
+def get_user_ids_after(after_id: int, limit: int) -> List[int]:
+    # Keyset pagination over the users primary key
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (after_id, limit)
+        ).fetchall()
+        return [r[0] for r in rows]
+
+
+def create_broadcast(text: str, total: int) -> int:
+    with get_db() as conn:
+        cur = conn.execute(
+            "INSERT INTO broadcasts (text, total, started_at) VALUES (?, ?, ?)",
+            (text, total, datetime.now().isoformat())
+        )
+        return cur.lastrowid
+
+
+def record_broadcast_results(broadcast_id: int, results: List[Tuple[int, str, Optional[str]]]):
+    with get_db() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO broadcast_results (broadcast_id, user_id, status, error) VALUES (?, ?, ?, ?)",
+            [(broadcast_id, user_id, status, error) for user_id, status, error in results]
+        )
+
+
+def finish_broadcast(broadcast_id: int, status: str, sent: int, failed: int):
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE broadcasts SET status = ?, sent = ?, failed = ?, finished_at = ? WHERE broadcast_id = ?",
+            (status, sent, failed, datetime.now().isoformat(), broadcast_id)
+        )
 
 
 def get_stats():
@@ -235,175 +626,2263 @@ def get_stats():
 
 
 # ==========================================
-# VALIDATION
+# METRICS
 # ==========================================
-def validate_python_code(code: str) -> Tuple[bool, str]:
-    # UNRESTRICTED: Allows 'import os' etc.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    # Per-bucket (non-cumulative) counts; cumulated only when rendered
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(LATENCY_BUCKETS, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+HANDLER_LATENCY: Dict[str, Histogram] = {}   # bot id -> update handling time
+DB_LATENCY: Dict[str, Histogram] = {}        # helper name -> executor round trip
+OUTBOUND_LATENCY: Dict[str, Histogram] = {}  # call name -> HTTP latency
+LOOP_LAG = Histogram()
+LOOP_LAG_STATS = {"last": 0.0, "max": 0.0}
+
+
+def observe(family: Dict[str, Histogram], key: str, value: float):
+    hist = family.get(key)
+    if hist is None:
+        hist = family[key] = Histogram()
+    hist.observe(value)
+
+
+async def loop_lag_monitor():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(lag)
+        LOOP_LAG_STATS["last"] = lag
+        if lag > LOOP_LAG_STATS["max"]:
+            LOOP_LAG_STATS["max"] = lag
+        if lag >= SLOW_CALLBACK_THRESHOLD:
+            # Blame the last hosted handler step that held the loop within this interval
+            blocker = LAST_BLOCKER if time.monotonic() - LAST_BLOCKER["at"] <= lag + LOOP_LAG_INTERVAL else None
+            culprit = f"bot {blocker['bot']} held it for {blocker['wall']:.2f}s" if blocker else "no handler step to blame"
+            LAG_EVENTS.append((time.time(), lag, culprit))
+            logger.warning(f"Event loop lagged {lag:.2f}s ({culprit})")
+
+
+def _label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _render_histograms(lines: List[str], name: str, help_text: str, label: str, family: Dict[str, Histogram]):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for key, hist in sorted(family.items()):
+        prefix = f'{label}="{_label(key)}",' if label else ""
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, hist.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {hist.count}')
+        suffix = f"{{{prefix.rstrip(',')}}}" if prefix else ""
+        lines.append(f"{name}_sum{suffix} {hist.sum:.6f}")
+        lines.append(f"{name}_count{suffix} {hist.count}")
+
+
+def _render_gauge(lines: List[str], name: str, help_text: str, samples: List[Tuple[str, Any]], kind: str = "gauge"):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in samples:
+        lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+
+_BOT_UPDATE_RESULTS = ("received", "processed", "failed", "dropped", "rejected")
+
+
+def bot_metrics_snapshot() -> Dict[str, Any]:
+    # Per-bot series of this process as plain JSON; worker shards send theirs
+    # to the parent over the shard socket when /metrics is scraped
+    bots = {}
+    for d in DISPATCHERS.values():
+        bots[d.bot_id] = {result: getattr(d, result) for result in _BOT_UPDATE_RESULTS}
+        bots[d.bot_id].update(queue=d.queue.qsize(), throttled=d.throttled)
+    return {
+        "bots": bots,
+        "duplicates": {token.split(":", 1)[0]: w.duplicates for token, w in UPDATE_WINDOWS.items()},
+        "handler": {bot_id: [h.counts, h.sum, h.count] for bot_id, h in HANDLER_LATENCY.items()},
+    }
+
+
+def _merge_bot_metrics(snapshots: List[Dict[str, Any]]) -> Tuple[Dict[str, Dict[str, int]], Dict[str, int], Dict[str, Histogram]]:
+    bots: Dict[str, Dict[str, int]] = {}
+    duplicates: Dict[str, int] = {}
+    handler: Dict[str, Histogram] = {}
+    for snapshot in snapshots:
+        bots.update(snapshot["bots"])
+        for bot_id, count in snapshot["duplicates"].items():
+            duplicates[bot_id] = duplicates.get(bot_id, 0) + count
+        for bot_id, (counts, total, count) in snapshot["handler"].items():
+            hist = handler.get(bot_id)
+            if hist is None:
+                hist = handler[bot_id] = Histogram()
+            hist.counts = [a + b for a, b in zip(hist.counts, counts)]
+            hist.sum += total
+            hist.count += count
+    return bots, duplicates, handler
+
+
+def render_metrics(shard_snapshots: List[Dict[str, Any]] = ()) -> str:
+    # Scrape-time snapshot; hot paths only bump counters and histograms
+    lines: List[str] = []
+    bots, duplicates, handler = _merge_bot_metrics([bot_metrics_snapshot(), *shard_snapshots])
+    bot_ids = sorted(bots)
+    updates = []
+    for bot_id in bot_ids:
+        for result in _BOT_UPDATE_RESULTS:
+            updates.append((f'bot="{bot_id}",result="{result}"', bots[bot_id][result]))
+    _render_gauge(lines, "hostkaro_bot_updates_total", "Updates seen by each bot's dispatcher since it started.", updates, "counter")
+    _render_gauge(lines, "hostkaro_duplicate_updates_total", "Redelivered updates dropped by the update_id window.",
+                  [(f'bot="{bot_id}"', count) for bot_id, count in sorted(duplicates.items())], "counter")
+    _render_gauge(lines, "hostkaro_bot_queue_depth", "Updates waiting in each bot's dispatch queue.",
+                  [(f'bot="{bot_id}"', bots[bot_id]["queue"]) for bot_id in bot_ids])
+    _render_gauge(lines, "hostkaro_bot_throttled_total", "Times each bot was throttled for holding the event loop.",
+                  [(f'bot="{bot_id}"', bots[bot_id]["throttled"]) for bot_id in bot_ids], "counter")
+    _render_histograms(lines, "hostkaro_handler_seconds", "Time to process one update, per bot.", "bot", handler)
+    _render_gauge(lines, "hostkaro_webhook_queue_depth", "Updates waiting across all dispatch queues.",
+                  [("", sum(bot["queue"] for bot in bots.values()))])
+    _render_histograms(lines, "hostkaro_db_seconds", "Database helper latency including executor queueing.", "op", DB_LATENCY)
+    _render_histograms(lines, "hostkaro_outbound_seconds", "Outbound Telegram and Gemini call latency.", "call", OUTBOUND_LATENCY)
+    _render_gauge(lines, "hostkaro_outbound_errors_total", "Failed outbound calls.",
+                  [(f'call="{_label(name)}"', stats["errors"]) for name, stats in sorted(OUTBOUND_STATS.items())], "counter")
+    _render_gauge(lines, "hostkaro_active_bots", "Hosted bots by state.",
+                  [('state="active"', active_bot_count()), ('state="dormant"', len(DORMANT_BOTS))])
+    if POLLER:
+        polling = POLLER.stats()
+        _render_gauge(lines, "hostkaro_poll_inflight", "getUpdates requests in flight and the adaptive limit.",
+                      [('kind="inflight"', polling["inflight"]), ('kind="limit"', polling["limit"])])
+        _render_gauge(lines, "hostkaro_poll_total", "getUpdates results since start.",
+                      [('result="polls"', polling["polls"]), ('result="updates"', polling["updates"]), ('result="errors"', polling["errors"])], "counter")
+    _render_gauge(lines, "hostkaro_hosted_requests_total", "Hosted bots' Bot API calls through the shared pool.",
+                  [(f'result="{key}"', value) for key, value in HOSTED_REQUEST_STATS.items()], "counter")
+    _render_gauge(lines, "hostkaro_persistence_pending", "Hosted bot state keys not yet flushed to the database.",
+                  [("", len(PERSISTENCE_DIRTY))])
+    _render_gauge(lines, "hostkaro_pending_update_counts", "Update counts not yet flushed to the database.",
+                  [("", _pending_update_total)])
+    _render_histograms(lines, "hostkaro_event_loop_lag_seconds", "Event loop scheduling delay.", "", {"": LOOP_LAG})
+    _render_gauge(lines, "hostkaro_event_loop_lag_max_seconds", "Worst event loop lag since start.",
+                  [("", f"{LOOP_LAG_STATS['max']:.6f}")])
+    memory = [('process="main"', process_rss())]
+    if WORKER_POOL:
+        memory += [(f'process="shard{shard.index}"', process_rss(shard.process.pid)) for shard in WORKER_POOL.shards if shard.process]
+    _render_gauge(lines, "hostkaro_resident_memory_bytes", "Resident set size.", memory)
+    return "\n".join(lines) + "\n"
+
+
+async def metrics_handler(request):
+    if METRICS_TOKEN:
+        auth = request.headers.get("Authorization", "")
+        if auth != f"Bearer {METRICS_TOKEN}" and request.query.get("token") != METRICS_TOKEN:
+            return web.Response(status=401)
+    shard_snapshots = await WORKER_POOL.metrics() if WORKER_POOL else []
+    return web.Response(body=render_metrics(shard_snapshots).encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+# ==========================================
+# PROFILING
+# ==========================================
+SLOW_UPDATES: deque = deque(maxlen=SLOW_UPDATE_HISTORY)  # (time, bot id, update kind, wall, worst step)
+LAG_EVENTS: deque = deque(maxlen=SLOW_UPDATE_HISTORY)    # (time, lag, culprit)
+LAST_BLOCKER = {"bot": None, "wall": 0.0, "at": 0.0}
+_profile_lock = asyncio.Lock()
+
+
+def note_blocking(bot_id: str, wall: float):
+    LAST_BLOCKER["bot"] = bot_id
+    LAST_BLOCKER["wall"] = wall
+    LAST_BLOCKER["at"] = time.monotonic()
+
+
+def _format_profile(profiler: cProfile.Profile, header: List[str]) -> str:
+    out = StringIO()
+    out.write("\n".join(header) + "\n")
+    for key in ("tottime", "cumulative"):
+        out.write(f"\n=== cProfile, top {PROFILE_TOP} by {key} ===\n")
+        pstats.Stats(profiler, stream=out).strip_dirs().sort_stats(key).print_stats(PROFILE_TOP)
+    return out.getvalue()
+
+
+async def profile_event_loop(seconds: float) -> str:
+    # Profiles the loop thread, i.e. the platform and every in-process bot
+    async with _profile_lock:
+        busy_before = {d.bot_id: d.busy_time for d in DISPATCHERS.values()}
+        lag_before = (LOOP_LAG.count, LOOP_LAG.sum)
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        elapsed = time.perf_counter() - started
+
+        samples, lag_total = LOOP_LAG.count - lag_before[0], LOOP_LAG.sum - lag_before[1]
+        header = [
+            f"Profile window: {elapsed:.1f}s at {datetime.now().isoformat(timespec='seconds')}",
+            f"Loop lag: {samples} samples, avg {lag_total / samples * 1000 if samples else 0:.1f}ms, worst ever {LOOP_LAG_STATS['max'] * 1000:.0f}ms",
+            f"Bots: {active_bot_count()} active, {len(DORMANT_BOTS)} dormant",
+            "",
+            "=== Loop time held per bot during the window ===",
+        ]
+        busy = sorted(((d.busy_time - busy_before.get(d.bot_id, 0.0), d.bot_id) for d in DISPATCHERS.values()), reverse=True)
+        header += [f"bot {bot_id}: {held:.3f}s ({held / elapsed:.1%})" for held, bot_id in busy[:15] if held > 0] or ["(none)"]
+        header += ["", f"=== Recent updates slower than {SLOW_UPDATE_THRESHOLD:.1f}s ==="]
+        header += [
+            f"{datetime.fromtimestamp(at).isoformat(timespec='seconds')} bot {bot_id} {kind}: {wall:.2f}s (worst step {step:.2f}s)"
+            for at, bot_id, kind, wall, step in reversed(SLOW_UPDATES)
+        ] or ["(none)"]
+        header += ["", "=== Recent event loop stalls ==="]
+        header += [
+            f"{datetime.fromtimestamp(at).isoformat(timespec='seconds')} {lag:.2f}s: {culprit}"
+            for at, lag, culprit in reversed(LAG_EVENTS)
+        ] or ["(none)"]
+        return await asyncio.to_thread(_format_profile, profiler, header)
+
+
+# ==========================================
+# ASYNC DATABASE FACADE
+# ==========================================
+class AsyncDB:
+    # All writes go through a single writer thread, so they are applied in
+    # submission order (and therefore in order for any given bot). Reads run
+    # on a small pool; each thread keeps its own WAL connection via get_db().
+    def __init__(self, readers: int = 4):
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+
+    async def write(self, fn, *args):
+        started = time.perf_counter()
+        try: return await asyncio.get_running_loop().run_in_executor(self._writer, functools.partial(fn, *args))
+        finally: observe(DB_LATENCY, fn.__name__, time.perf_counter() - started)
+
+    async def read(self, fn, *args):
+        started = time.perf_counter()
+        try: return await asyncio.get_running_loop().run_in_executor(self._readers, functools.partial(fn, *args))
+        finally: observe(DB_LATENCY, fn.__name__, time.perf_counter() - started)
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        close_db()
+
+    # Writes
+    async def save_user(self, user_id: int, username: str, first_name: str):
+        return await self.write(save_user, user_id, username, first_name)
+
+    async def save_bot(self, user_id: int, token: str, file_path: str, creation_type: str, bot_username: str = None):
+        return await self.write(save_bot, user_id, token, file_path, creation_type, bot_username)
+
+    async def update_bot_status(self, token: str, status: str, error: str = None):
+        return await self.write(update_bot_status, token, status, error)
+
+    async def persist_update_counts(self, batch: List[Tuple[str, int]]):
+        return await self.write(persist_update_counts, batch)
+
+    async def save_bot_state(self, batch: List[Tuple[int, str, str, Optional[bytes]]]):
+        return await self.write(save_bot_state, batch)
+
+    async def create_broadcast(self, text: str, total: int) -> int:
+        return await self.write(create_broadcast, text, total)
+
+    async def record_broadcast_results(self, broadcast_id: int, results: List[Tuple[int, str, Optional[str]]]):
+        return await self.write(record_broadcast_results, broadcast_id, results)
+
+    async def finish_broadcast(self, broadcast_id: int, status: str, sent: int, failed: int):
+        return await self.write(finish_broadcast, broadcast_id, status, sent, failed)
+
+    async def set_bot_error(self, token: str, error: str):
+        return await self.write(set_bot_error, token, error)
+
+    async def toggle_bot_block(self, token: str) -> bool:
+        return await self.write(toggle_bot_block, token)
+
+    async def delete_bot_from_db(self, token: str):
+        return await self.write(delete_bot_from_db, token)
+
+    # Reads
+    async def get_user_bots(self, user_id: int):
+        return await self.read(get_user_bots, user_id)
+
+    async def get_all_bots_admin(self):
+        return await self.read(get_all_bots_admin)
+
+    async def get_all_running_bots(self):
+        return await self.read(get_all_running_bots)
+
+    async def load_bot_state(self, tg_bot_id: int):
+        return await self.read(load_bot_state, tg_bot_id)
+
+    async def get_bot(self, bot_id: int):
+        # Cache hits are answered inline without a thread hop
+        row = _BOT_ROWS.get(bot_id)
+        return row if row is not None else await self.read(get_bot, bot_id)
+
+    async def get_gemini_cache(self, cache_key: str) -> Optional[str]:
+        # Hits bump last_used, so this goes through the writer to stay ordered
+        return await self.write(get_gemini_cache, cache_key)
+
+    async def put_gemini_cache(self, cache_key: str, response: str):
+        return await self.write(put_gemini_cache, cache_key, response)
+
+    async def count_users(self) -> int:
+        return await self.read(count_users)
+
+    async def get_user_ids_after(self, after_id: int, limit: int) -> List[int]:
+        return await self.read(get_user_ids_after, after_id, limit)
+
+    async def get_stats(self):
+        return await self.read(get_stats)
+
+
+db = AsyncDB(readers=DB_READ_THREADS)
+
+
+# ==========================================
+# UPDATE COUNTERS
+# ==========================================
+def increment_bot_update_count(token: str):
+    # Write-behind: deltas are aggregated in memory and persisted by flush_update_counts()
+    global _pending_update_total
+    PENDING_UPDATE_COUNTS[token] = PENDING_UPDATE_COUNTS.get(token, 0) + 1
+    _pending_update_total += 1
+    if _pending_update_total >= UPDATE_FLUSH_THRESHOLD:
+        _update_flush_wakeup.set()
+
+
+def pending_update_count(token: str) -> int:
+    # Deltas of a flush still in flight are not in the DB row yet either
+    return PENDING_UPDATE_COUNTS.get(token, 0) + FLUSHING_UPDATE_COUNTS.get(token, 0)
+
+
+async def flush_update_counts() -> int:
+    global _pending_update_total
+    if not PENDING_UPDATE_COUNTS or FLUSHING_UPDATE_COUNTS:
+        return 0
+    batch = list(PENDING_UPDATE_COUNTS.items())
+    FLUSHING_UPDATE_COUNTS.update(batch)
+    PENDING_UPDATE_COUNTS.clear()
+    _pending_update_total = 0
     try:
-        ast.parse(code)
-    except SyntaxError as e:
-        return False, f"Syntax Error at line {e.lineno}: {e.msg}"
-    return True, "OK"
+        await db.persist_update_counts(batch)
+    except Exception:
+        # Put the deltas back so the next flush retries them
+        for token, delta in batch:
+            PENDING_UPDATE_COUNTS[token] = PENDING_UPDATE_COUNTS.get(token, 0) + delta
+            _pending_update_total += delta
+        raise
+    finally:
+        FLUSHING_UPDATE_COUNTS.clear()
+    return len(batch)
 
 
-def detect_imports(file_path: str) -> set:
-    with open(file_path, "r", encoding="utf-8") as f:
+async def update_count_flusher():
+    while True:
         try:
-            tree = ast.parse(f.read())
-        except SyntaxError:
-            return set()
-    imports = set()
-    for node in ast.walk(tree):
-        if isinstance(node, ast.Import):
-            for alias in node.names:
-                imports.add(alias.name.split('.')[0])
-        elif isinstance(node, ast.ImportFrom):
-            if node.module:
-                imports.add(node.module.split('.')[0])
-    return imports
+            await asyncio.wait_for(_update_flush_wakeup.wait(), timeout=UPDATE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _update_flush_wakeup.clear()
+        try:
+            await flush_update_counts()
+        except Exception as e:
+            logger.error(f"Update count flush failed: {e}")
 
 
 # ==========================================
-# BOT MANAGER
+# RATE LIMITING
 # ==========================================
-async def install_dependencies(file_path: str) -> Tuple[bool, str]:
-    imports = detect_imports(file_path)
-    stdlib = {
-        'os', 'sys', 'asyncio', 'logging', 'json', 're', 'typing', 'datetime',
-        'time', 'random', 'math', 'collections', 'itertools', 'functools',
-        'pathlib', 'io', 'hashlib', 'base64', 'urllib', 'http', 'html',
-        'sqlite3', 'pickle', 'copy', 'threading', 'contextlib', 'string'
-    }
-    
-    # Package Mapping
-    package_map = {
-        'telegram': 'python-telegram-bot',
-        'PIL': 'Pillow',
-        'cv2': 'opencv-python',
-        'sklearn': 'scikit-learn',
-        'yaml': 'pyyaml',
-        'bs4': 'beautifulsoup4',
-        'requests': 'requests',
-        'numpy': 'numpy',
-        'google': 'google-generativeai', 
-        'google.generativeai': 'google-generativeai'
-    }
-    
-    to_install = []
-    for lib in imports:
-        if lib in stdlib: continue
-        pkg = package_map.get(lib, lib)
+class RateLimiter:
+    # Token bucket: `rate` acquisitions per second with bursts of up to `burst`
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# ==========================================
+# HTTP CLIENT
+# ==========================================
+# One keep-alive session for all outbound HTTP (Bot API, Gemini), so calls
+# reuse pooled TCP/TLS connections instead of handshaking every time
+_http_session: Optional[ClientSession] = None
+OUTBOUND_STATS: Dict[str, Dict[str, float]] = {}
+
+
+def get_http_session() -> ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE
+        )
+        _http_session = ClientSession(connector=connector, timeout=ClientTimeout(total=300))
+    return _http_session
+
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+def record_outbound(name: str, elapsed: float, ok: bool):
+    stats = OUTBOUND_STATS.setdefault(name, {"count": 0, "errors": 0, "total": 0.0, "max": 0.0})
+    stats["count"] += 1
+    stats["total"] += elapsed
+    stats["max"] = max(stats["max"], elapsed)
+    if not ok:
+        stats["errors"] += 1
+    observe(OUTBOUND_LATENCY, name, elapsed)
+    logger.debug(f"Outbound {name}: {elapsed * 1000:.0f}ms{'' if ok else ' (failed)'}")
+
+
+@asynccontextmanager
+async def timed_call(name: str):
+    started = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        record_outbound(name, time.perf_counter() - started, ok)
+
+
+# ==========================================
+# SHARED BOT REQUESTS
+# ==========================================
+# Hosted bots' Applications get a SharedBotRequest injected at build time
+# instead of two private HTTPX clients each. All of them send through one
+# keep-alive aiohttp pool (httpcore's pool scans every connection for each
+# queued request, which degrades badly at this size); rate limiting and
+# flood-wait retries happen here, before PTB sees the response.
+_bot_api_session: Optional[ClientSession] = None
+_BOT_SEND_LIMITERS: Dict[str, RateLimiter] = {}
+_BOT_FLOOD_UNTIL: Dict[str, float] = {}
+_global_send_limiter: Optional[RateLimiter] = None
+HOSTED_REQUEST_STATS: Dict[str, int] = {"requests": 0, "rate_limited": 0, "retried": 0}
+_RATE_LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+_DEFAULT_READ_TIMEOUT = 5.0
+_DEFAULT_CONNECT_TIMEOUT = 5.0
+_MEDIA_READ_TIMEOUT = 20.0
+
+
+def get_bot_api_session() -> ClientSession:
+    global _bot_api_session
+    if _bot_api_session is None or _bot_api_session.closed:
+        connector = TCPConnector(limit=SHARED_POOL_SIZE, ttl_dns_cache=HTTP_DNS_TTL, keepalive_timeout=HTTP_KEEPALIVE)
+        _bot_api_session = ClientSession(connector=connector, headers={"User-Agent": BaseRequest.USER_AGENT})
+    return _bot_api_session
+
+
+async def close_bot_api_session():
+    global _bot_api_session
+    if _bot_api_session is not None and not _bot_api_session.closed:
+        await _bot_api_session.close()
+    _bot_api_session = None
+
+
+def _timeout(value, default: Optional[float]) -> Optional[float]:
+    return default if value is BaseRequest.DEFAULT_NONE else value
+
+
+class SharedBotRequest(BaseRequest):
+    def __init__(self, token: str):
+        self.token = token
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return _DEFAULT_READ_TIMEOUT
+
+    async def initialize(self):
+        get_bot_api_session()
+
+    async def shutdown(self):
+        # The pool outlives any single bot; closed in shutdown_platform
+        pass
+
+    async def _throttle(self):
+        global _global_send_limiter
+        wait = _BOT_FLOOD_UNTIL.get(self.token, 0) - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        limiter = _BOT_SEND_LIMITERS.get(self.token)
+        if limiter is None:
+            limiter = _BOT_SEND_LIMITERS[self.token] = RateLimiter(BOT_SEND_RATE, burst=int(BOT_SEND_RATE))
+        await limiter.acquire()
+        if GLOBAL_SEND_RATE > 0:
+            if _global_send_limiter is None:
+                _global_send_limiter = RateLimiter(GLOBAL_SEND_RATE, burst=int(GLOBAL_SEND_RATE))
+            await _global_send_limiter.acquire()
+
+    async def _send(self, url: str, method: str, request_data: Optional[RequestData], timeout: ClientTimeout) -> Tuple[int, bytes]:
+        data = None
+        if request_data is not None:
+            files = request_data.multipart_data
+            if files:
+                data = FormData()
+                for name, value in request_data.json_parameters.items():
+                    data.add_field(name, value)
+                for name, (filename, content, mimetype) in files.items():
+                    data.add_field(name, content, filename=filename, content_type=mimetype)
+            else:
+                data = request_data.json_parameters
         try:
-            importlib.metadata.version(pkg.split('>=')[0].split('==')[0])
-        except importlib.metadata.PackageNotFoundError:
-            to_install.append(pkg)
-            
-    if to_install:
+            async with get_bot_api_session().request(method, url, data=data, timeout=timeout) as resp:
+                return resp.status, await resp.read()
+        except asyncio.TimeoutError as e:
+            raise TimedOut() from e
+        except ClientError as e:
+            raise NetworkError(f"aiohttp.{type(e).__name__}: {e}") from e
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout=BaseRequest.DEFAULT_NONE,
+        write_timeout=BaseRequest.DEFAULT_NONE,
+        connect_timeout=BaseRequest.DEFAULT_NONE,
+        pool_timeout=BaseRequest.DEFAULT_NONE,
+    ) -> Tuple[int, bytes]:
+        uploads = request_data is not None and request_data.contains_files
+        read = _timeout(read_timeout, _DEFAULT_READ_TIMEOUT)
+        if uploads and read is not None:
+            # aiohttp has no write timeout; give uploads room on the read side
+            read += _timeout(write_timeout, _MEDIA_READ_TIMEOUT) or 0
+        connect = _timeout(connect_timeout, _DEFAULT_CONNECT_TIMEOUT)
+        pool = _timeout(pool_timeout, SHARED_POOL_TIMEOUT)
+        timeout = ClientTimeout(
+            total=None, sock_read=read, sock_connect=connect,
+            connect=None if connect is None or pool is None else connect + pool
+        )
+        limited = BOT_SEND_RATE > 0 and url.rsplit("/", 1)[-1].startswith(_RATE_LIMITED_PREFIXES)
+        for attempt in range(RETRY_AFTER_ATTEMPTS + 1):
+            if limited:
+                await self._throttle()
+            HOSTED_REQUEST_STATS["requests"] += 1
+            async with timed_call("telegram.hosted"):
+                code, payload = await self._send(url, method, request_data, timeout)
+            if code != 429 or attempt == RETRY_AFTER_ATTEMPTS:
+                return code, payload
+            HOSTED_REQUEST_STATS["rate_limited"] += 1
+            try: retry_after = json.loads(payload)["parameters"]["retry_after"]
+            except (ValueError, KeyError, TypeError): retry_after = 1
+            if retry_after > RETRY_AFTER_MAX:
+                # Too long to hold the handler; PTB raises RetryAfter to the bot
+                return code, payload
+            # Telegram's flood wait covers the whole bot, not just this call
+            _BOT_FLOOD_UNTIL[self.token] = time.monotonic() + retry_after
+            HOSTED_REQUEST_STATS["retried"] += 1
+            await asyncio.sleep(retry_after)
+        return code, payload
+
+
+def forget_bot_request_state(token: str):
+    _BOT_SEND_LIMITERS.pop(token, None)
+    _BOT_FLOOD_UNTIL.pop(token, None)
+
+
+# Token and module name of the bot whose module is executing in load_user_app;
+# builds made while they are set belong to a hosted bot and get the platform defaults
+_loading_bot: contextvars.ContextVar = contextvars.ContextVar("loading_bot", default=None)
+_loading_module: contextvars.ContextVar = contextvars.ContextVar("loading_module", default=None)
+_original_build = ApplicationBuilder.build
+
+
+def _check_builder_internals():
+    # _apply_platform_defaults reads ApplicationBuilder's private fields, which
+    # PTB does not keep stable; refuse to start on a release where they moved
+    # rather than silently misconfiguring every hosted bot
+    builder = ApplicationBuilder()
+    problems = [f"ApplicationBuilder.{attr}" for attr in ("_request", "_get_updates_request", "_persistence", "_context_types")
+                if not hasattr(builder, attr)]
+    if not problems:
+        if not (builder._request is builder._get_updates_request is builder._persistence is BaseRequest.DEFAULT_NONE):
+            problems.append("DEFAULT_NONE sentinel")
+        if not isinstance(DefaultValue.get_value(builder._context_types), ContextTypes):
+            problems.append("default ContextTypes")
+    if problems:
+        raise RuntimeError(
+            f"python-telegram-bot {PTB_VERSION} is not supported (changed: {', '.join(problems)}); "
+            f"install the version pinned in requirements.txt"
+        )
+
+
+_check_builder_internals()
+
+
+def _apply_platform_defaults(builder: ApplicationBuilder, token: str):
+    if SHARED_BOT_REQUESTS:
+        for attr, setter in (("_request", builder.request), ("_get_updates_request", builder.get_updates_request)):
+            if getattr(builder, attr) is not BaseRequest.DEFAULT_NONE:
+                continue  # the bot passed its own request object
+            try: setter(SharedBotRequest(token))
+            except RuntimeError: pass  # the bot set pool size, timeouts or a proxy
+    tg_bot_id = token.split(":", 1)[0]
+    if BOT_PERSISTENCE and tg_bot_id.isdigit() and builder._persistence is BaseRequest.DEFAULT_NONE:
+        context_types = DefaultValue.get_value(builder._context_types)
+        builder.persistence(PlatformPersistence(int(tg_bot_id), _loading_module.get(), context_types))
+
+
+def _build_with_platform_defaults(self, *args, **kwargs):
+    token = _loading_bot.get()
+    if token is not None:
+        _apply_platform_defaults(self, token)
+    app = _original_build(self, *args, **kwargs)
+    if isinstance(app.persistence, PlatformPersistence):
+        app.persistence.application = weakref.ref(app)
+    return app
+
+
+ApplicationBuilder.build = _build_with_platform_defaults
+
+
+# ==========================================
+# BOT PERSISTENCE
+# ==========================================
+# Hosted bots get a PlatformPersistence unless they bring their own. PTB
+# already reports only the keys a handler touched; each one is pickled into
+# PERSISTENCE_DIRTY and the flusher writes every bot's changes in a single
+# transaction. Rows are keyed by the Telegram bot id, so state survives
+# restarts, redeploys and token changes.
+PERSISTENCE_DIRTY: Dict[Tuple[int, str, str], Optional[bytes]] = {}
+PERSISTENCE_FLUSHING: Dict[Tuple[int, str, str], Optional[bytes]] = {}  # batch being written
+_persistence_flush_lock = asyncio.Lock()
+_persistence_flusher: Optional[asyncio.Task] = None
+
+
+class _StateUnpickler(pickle.Unpickler):
+    # Classes pickled from an earlier load of the bot live in a module with an
+    # older userbot_* name; resolve them in the module being loaded now
+    def __init__(self, data: bytes, module_name: Optional[str]):
+        super().__init__(BytesIO(data))
+        self.module_name = module_name
+
+    def find_class(self, module: str, name: str):
+        if module.startswith("userbot_") and self.module_name:
+            module = self.module_name
+        return super().find_class(module, name)
+
+
+class PlatformPersistence(BasePersistence):
+    def __init__(self, tg_bot_id: int, module_name: Optional[str] = None, context_types: Optional[ContextTypes] = None):
+        super().__init__(update_interval=PERSISTENCE_UPDATE_INTERVAL)
+        self.tg_bot_id = tg_bot_id
+        self.module_name = module_name
+        self.context_types = context_types or ContextTypes()
+        self.application: Optional[weakref.ref] = None  # set once the builder has built the app
+        # Rows are kept only while initialize() reads every kind, then released
+        self._rows: Optional[Dict[Tuple[str, str], bytes]] = None
+        self._released = False
+        self._unpicklable: set = set()
+
+    async def _load(self) -> Dict[Tuple[str, str], bytes]:
+        rows = self._rows
+        if rows is None:
+            _ensure_persistence_flusher()
+            rows = {(r["kind"], r["key"]): r["data"] for r in await db.load_bot_state(self.tg_bot_id)}
+            # Unflushed changes (e.g. from the instance being hot-reloaded) are newer
+            for (tg_bot_id, kind, key), data in list(PERSISTENCE_FLUSHING.items()) + list(PERSISTENCE_DIRTY.items()):
+                if tg_bot_id == self.tg_bot_id:
+                    if data is None: rows.pop((kind, key), None)
+                    else: rows[(kind, key)] = data
+            if not self._released:
+                self._rows = rows
+        return rows
+
+    def release_rows(self):
+        # Called by load_user_app after initialize(); a conversation handler
+        # added later reads its states from the database again
+        self._released = True
+        self._rows = None
+
+    async def _get(self, kind: str) -> Dict[str, Any]:
+        result = {}
+        for (row_kind, key), data in (await self._load()).items():
+            if row_kind != kind:
+                continue
+            try: result[key] = _StateUnpickler(data, self.module_name).load()
+            except Exception as e: logger.warning(f"Skipping unreadable {kind} state {key} of bot {self.tg_bot_id}: {e}")
+        return result
+
+    def _mark(self, kind: str, key: str, data: Any):
         try:
-            logger.info(f"Installing: {to_install}")
-            result = subprocess.run(
-                [sys.executable, "-m", "pip", "install"] + to_install,
-                capture_output=True, text=True, timeout=120
-            )
-            if result.returncode != 0:
-                return False, result.stderr[:200]
-        except subprocess.TimeoutExpired:
-            return False, "Installation timed out"
+            value = None if data is None else pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
         except Exception as e:
-            return False, str(e)
+            # e.g. a lambda or socket kept in user_data: skip this key, keep the rest
+            if (kind, key) not in self._unpicklable:
+                self._unpicklable.add((kind, key))
+                logger.warning(f"Not persisting {kind} state {key or '-'} of bot {self.tg_bot_id}: {e}")
+            return
+        self._unpicklable.discard((kind, key))
+        PERSISTENCE_DIRTY[(self.tg_bot_id, kind, key)] = value
+        if self._rows is not None:
+            if value is None: self._rows.pop((kind, key), None)
+            else: self._rows[(kind, key)] = value
+
+    async def get_user_data(self) -> Dict[int, Any]:
+        return {int(key): data for key, data in (await self._get("user")).items()}
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {int(key): data for key, data in (await self._get("chat")).items()}
+
+    async def get_bot_data(self) -> Any:
+        stored = await self._get("bot")
+        # initialize() replaces application.bot_data with this, so start from
+        # whatever the bot put there at import time
+        app = self.application() if self.application else None
+        seeded = app.bot_data if app is not None else self.context_types.bot_data()
+        if "" not in stored:
+            return seeded
+        if isinstance(seeded, dict) and isinstance(stored[""], dict):
+            seeded.update(stored[""])
+            return seeded
+        return stored[""]
+
+    async def get_callback_data(self) -> Optional[Any]:
+        return (await self._get("callback")).get("")
+
+    async def get_conversations(self, name: str) -> Dict[tuple, object]:
+        return {tuple(json.loads(key)): state for key, state in (await self._get(f"conv:{name}")).items()}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]):
+        self._mark(f"conv:{name}", json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id: int, data: Any):
+        self._mark("user", str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: Any):
+        self._mark("chat", str(chat_id), data)
+
+    async def update_bot_data(self, data: Any):
+        self._mark("bot", "", data)
+
+    async def update_callback_data(self, data: Any):
+        self._mark("callback", "", data)
+
+    async def drop_user_data(self, user_id: int):
+        self._mark("user", str(user_id), None)
+
+    async def drop_chat_data(self, chat_id: int):
+        self._mark("chat", str(chat_id), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: Any):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any):
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any):
+        pass
+
+    async def flush(self):
+        # Called from Application.shutdown after the final update_persistence
+        try: await flush_persistence()
+        except Exception as e: logger.error(f"Persistence flush failed for bot {self.tg_bot_id}: {e}")
+
+
+async def flush_persistence() -> int:
+    async with _persistence_flush_lock:
+        if not PERSISTENCE_DIRTY:
+            return 0
+        batch = [(tg_bot_id, kind, key, data) for (tg_bot_id, kind, key), data in PERSISTENCE_DIRTY.items()]
+        # Stays visible to PlatformPersistence._load until the write has committed
+        PERSISTENCE_FLUSHING.update(PERSISTENCE_DIRTY)
+        PERSISTENCE_DIRTY.clear()
+        try:
+            await db.save_bot_state(batch)
+        except Exception:
+            # Keep anything newer that arrived meanwhile, retry the rest next time
+            for tg_bot_id, kind, key, data in batch:
+                PERSISTENCE_DIRTY.setdefault((tg_bot_id, kind, key), data)
+            raise
+        finally:
+            PERSISTENCE_FLUSHING.clear()
+        return len(batch)
+
+
+async def persistence_flusher():
+    while True:
+        await asyncio.sleep(PERSISTENCE_FLUSH_INTERVAL)
+        try:
+            await flush_persistence()
+        except Exception as e:
+            logger.error(f"Persistence flush failed: {e}")
+
+
+def _ensure_persistence_flusher():
+    # Started on first use so worker processes get one as well
+    global _persistence_flusher
+    if _persistence_flusher is None or _persistence_flusher.done():
+        _persistence_flusher = asyncio.create_task(persistence_flusher())
+
+
+async def stop_persistence():
+    global _persistence_flusher
+    if _persistence_flusher is not None:
+        _persistence_flusher.cancel()
+        await asyncio.gather(_persistence_flusher, return_exceptions=True)
+        _persistence_flusher = None
+    try:
+        await flush_persistence()
+    except Exception as e:
+        logger.error(f"Final persistence flush failed: {e}")
+
+
+# ==========================================
+# CACHING
+# ==========================================
+class TTLCache:
+    # LRU-ordered mapping whose entries expire after a per-entry TTL. Locked:
+    # the analysis memo is used from asyncio.to_thread workers
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return default
+        return entry[1]
+
+    def set(self, key, value, ttl: float):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight:
+    # Coalesces concurrent calls for the same key into one in-flight call
+    def __init__(self):
+        self._inflight: Dict[Any, asyncio.Task] = {}
+        self.coalesced = 0
+
+    async def do(self, key, factory):
+        # The call runs as its own task, so cancelling any one caller
+        # (including the first) leaves it running for the others
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = self._inflight[key] = asyncio.create_task(factory())
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every caller was cancelled
+
+
+# ==========================================
+# UPDATE DISPATCH
+# ==========================================
+class _MeteredStep:
+    # Drives a coroutine and reports the wall/CPU time of every synchronous
+    # slice it runs on the loop, i.e. how long it kept other tasks waiting
+    __slots__ = ("_it", "_on_step")
+
+    def __init__(self, coro, on_step):
+        self._it = coro.__await__()
+        self._on_step = on_step
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def send(self, value):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            return self._it.send(value)
+        finally:
+            self._on_step(time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def throw(self, *args):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            return self._it.throw(*args)
+        finally:
+            self._on_step(time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def close(self):
+        self._it.close()
+
+
+# Shared by all hosted bots; waiters are served FIFO, so each bot gets at most
+# its worker count worth of slots and a busy tenant cannot crowd out the rest
+_sched_slots = asyncio.Semaphore(SCHED_MAX_CONCURRENT)
+
+
+class BotDispatcher:
+    # Bounded per-bot update queue drained by a fixed set of worker tasks, so
+    # webhook requests are acknowledged without waiting for the bot's handlers
+    def __init__(self, token: str, app: Application, workers: int, maxsize: int, scheduled: bool = True):
+        self.token = token
+        self.bot_id = token.split(":", 1)[0]
+        self.app = app
+        self.scheduled = scheduled
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.num_workers = workers
+        self.workers: List[asyncio.Task] = []
+        self._resume = asyncio.Event()
+        if app is not None:
+            self._resume.set()
+        self._active = 0
+        self.last_update = time.monotonic()
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.max_depth = 0
+        # Scheduling: handler wall time, loop time held by the bot's own code,
+        # CPU time, and throttling state
+        self.handler_time = 0.0
+        self.busy_time = 0.0
+        self.cpu_time = 0.0
+        self.max_step = 0.0
+        self.slow_steps = 0
+        self.throttled = 0
+        self.throttled_until = 0.0
+        self._window_start = time.monotonic()
+        self._window_busy = 0.0
+        self._last_error_log = 0.0
+
+    def start(self):
+        for i in range(self.num_workers):
+            self.workers.append(asyncio.create_task(self._worker(), name=f"dispatch-{self.token[:10]}-{i}"))
+
+    def submit(self, data: dict) -> bool:
+        # Returns False when the update was refused and Telegram should redeliver it
+        self.received += 1
+        self.last_update = time.monotonic()
+        if self.queue.full():
+            if UPDATE_OVERFLOW_POLICY == "drop_oldest":
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                except asyncio.QueueEmpty:
+                    pass
+                self.dropped += 1
+            elif UPDATE_OVERFLOW_POLICY == "drop_newest":
+                self.dropped += 1
+                return True
+            else:
+                self.rejected += 1
+                return False
+        self.queue.put_nowait(data)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    async def put(self, data: dict):
+        # Waits for room instead of refusing, for updates already acknowledged upstream
+        self.received += 1
+        self.last_update = time.monotonic()
+        await self.queue.put(data)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    async def pause(self, timeout: float):
+        # Stops taking updates off the queue (new ones keep buffering there)
+        # and waits for in-flight updates to finish
+        self._resume.clear()
+        deadline = time.monotonic() + timeout
+        while self._active and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def resume(self):
+        self._resume.set()
+
+    async def _worker(self):
+        while True:
+            data = await self.queue.get()
+            await self._resume.wait()
+            self._active += 1
+            try:
+                if self.scheduled:
+                    delay = self.throttled_until - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    async with _sched_slots:
+                        await self._process(data)
+                else:
+                    await self._process(data)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Update failed for {self.token[:15]}...: {e}")
+            finally:
+                self._active -= 1
+                self.queue.task_done()
+
+    async def _process(self, data: dict):
+        worst = [0.0]
+
+        def on_step(wall: float, cpu: float):
+            self.busy_time += wall
+            self.cpu_time += cpu
+            self._window_busy += wall
+            if wall > worst[0]:
+                worst[0] = wall
+            if wall >= SLOW_CALLBACK_THRESHOLD:
+                note_blocking(self.bot_id, wall)
+
+        started = time.perf_counter()
+        try:
+            update = Update.de_json(data, self.app.bot)
+            await _MeteredStep(self.app.process_update(update), on_step)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.handler_time += elapsed
+            observe(HANDLER_LATENCY, self.bot_id, elapsed)
+            if elapsed >= SLOW_UPDATE_THRESHOLD:
+                kind = next((k for k in data if k != "update_id"), "?")
+                SLOW_UPDATES.append((time.time(), self.bot_id, kind, elapsed, worst[0]))
+            if worst[0] > self.max_step:
+                self.max_step = worst[0]
+            if self.scheduled:
+                await self._enforce_budget(worst[0])
+
+    async def _enforce_budget(self, worst_step: float):
+        now = time.monotonic()
+        if now - self._window_start >= SCHED_WINDOW:
+            self._window_start = now
+            self._window_busy = 0.0
+        if worst_step >= SLOW_CALLBACK_THRESHOLD:
+            self.slow_steps += 1
+            reason = f"Handler blocked the event loop for {worst_step:.2f}s"
+        elif self._window_busy > SCHED_BUSY_BUDGET * SCHED_WINDOW:
+            reason = f"Handler used {self._window_busy:.2f}s of loop time in {SCHED_WINDOW:.0f}s"
+        else:
+            return
+        self.throttled += 1
+        self.throttled_until = now + SCHED_THROTTLE_SECONDS
+        self._window_start = now
+        self._window_busy = 0.0
+        logger.warning(f"Throttling {self.token[:15]}... for {SCHED_THROTTLE_SECONDS:.0f}s: {reason}")
+        if now - self._last_error_log >= 60:
+            self._last_error_log = now
+            try: await db.set_bot_error(self.token, f"[{datetime.now().isoformat(timespec='seconds')}] Throttled: {reason}")
+            except Exception as e: logger.error(f"Failed to record throttle for {self.token[:15]}...: {e}")
+
+    async def stop(self, drain_timeout: float = 0):
+        if drain_timeout and not self.queue.empty():
+            try: await asyncio.wait_for(self.queue.join(), timeout=drain_timeout)
+            except asyncio.TimeoutError: pass
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers.clear()
+
+
+class UpdateWindow:
+    # The last `size` accepted update_ids of one bot: a ring buffer fixes the
+    # eviction order, a set answers membership in O(1)
+    __slots__ = ("ring", "seen", "pos", "duplicates")
+
+    def __init__(self, size: int):
+        self.ring: List[Optional[int]] = [None] * size
+        self.seen: set = set()
+        self.pos = 0
+        self.duplicates = 0
+
+    def is_duplicate(self, update_id: int) -> bool:
+        if update_id in self.seen:
+            self.duplicates += 1
+            return True
+        return False
+
+    def add(self, update_id: int):
+        old = self.ring[self.pos]
+        if old is not None:
+            self.seen.discard(old)
+        self.ring[self.pos] = update_id
+        self.pos = (self.pos + 1) % len(self.ring)
+        self.seen.add(update_id)
+
+
+UPDATE_WINDOWS: Dict[str, UpdateWindow] = {}
+
+
+def update_window(token: str) -> Optional[UpdateWindow]:
+    if DEDUP_WINDOW <= 0:
+        return None
+    window = UPDATE_WINDOWS.get(token)
+    if window is None:
+        window = UPDATE_WINDOWS[token] = UpdateWindow(DEDUP_WINDOW)
+    return window
+
+
+DISPATCHERS: Dict[str, BotDispatcher] = {}
+
+
+def start_dispatcher(token: str, app: Optional[Application], workers: int = None, scheduled: bool = True) -> BotDispatcher:
+    # A dispatcher started without an app buffers updates until resume()
+    dispatcher = BotDispatcher(token, app, workers or UPDATE_WORKERS, UPDATE_QUEUE_SIZE, scheduled)
+    DISPATCHERS[token] = dispatcher
+    dispatcher.start()
+    return dispatcher
+
+
+async def stop_dispatcher(token: str, drain_timeout: float = 0):
+    dispatcher = DISPATCHERS.pop(token, None)
+    if dispatcher:
+        await dispatcher.stop(drain_timeout)
+
+
+def dispatch_stats() -> Dict[str, int]:
+    return {
+        "depth": sum(d.queue.qsize() for d in DISPATCHERS.values()),
+        "dropped": sum(d.dropped for d in DISPATCHERS.values()),
+        "rejected": sum(d.rejected for d in DISPATCHERS.values()),
+        "duplicates": sum(w.duplicates for w in UPDATE_WINDOWS.values()),
+    }
+
+
+# ==========================================
+# VALIDATION
+# ==========================================
+class CodeAnalysis(NamedTuple):
+    valid: bool
+    error: str
+    imports: frozenset
+    mentions_application: bool
+    code: Optional[CodeType]
+
+
+# Analyses are cached in memory and on disk, keyed by a hash of the path and
+# source (the path is baked into the code object), so restarts of unchanged
+# files skip parsing and compilation entirely
+_ANALYSIS_MEMO = TTLCache(ANALYSIS_MEMO_SIZE)
+
+
+def _analysis_cache_path(digest: str) -> str:
+    return os.path.join(ANALYSIS_CACHE_DIR, f"{digest}.bin")
+
+
+def _analysis_digest(source: str, filename: str) -> str:
+    return hashlib.sha256(f"{filename}\0{source}".encode()).hexdigest()
+
+
+def _load_cached_analysis(digest: str) -> Optional[CodeAnalysis]:
+    path = _analysis_cache_path(digest)
+    try:
+        with open(path, "rb") as f:
+            blob = f.read()
+        os.utime(path)  # mtime orders entries for _prune_analysis_cache
+    except OSError:
+        return None
+    magic = importlib.util.MAGIC_NUMBER
+    if not blob.startswith(magic):
+        return None
+    try:
+        valid, error, imports, mentions_application, code = marshal.loads(blob[len(magic):])
+    except (ValueError, EOFError, TypeError):
+        return None
+    return CodeAnalysis(valid, error, frozenset(imports), mentions_application, code)
+
+
+def _store_cached_analysis(digest: str, analysis: CodeAnalysis):
+    path = _analysis_cache_path(digest)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(ANALYSIS_CACHE_DIR, exist_ok=True)
+        blob = marshal.dumps((analysis.valid, analysis.error, sorted(analysis.imports), analysis.mentions_application, analysis.code))
+        with open(tmp, "wb") as f:
+            f.write(importlib.util.MAGIC_NUMBER + blob)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning(f"Could not write analysis cache: {e}")
+        return
+    _prune_analysis_cache()
+
+
+def _prune_analysis_cache():
+    # Uploads get a fresh path each time, so entries for replaced files would
+    # pile up forever; keep the most recently used ANALYSIS_CACHE_MAX_FILES
+    try:
+        names = [n for n in os.listdir(ANALYSIS_CACHE_DIR) if n.endswith(".bin")]
+        if len(names) <= ANALYSIS_CACHE_MAX_FILES:
+            return
+        paths = [os.path.join(ANALYSIS_CACHE_DIR, n) for n in names]
+        paths.sort(key=lambda p: os.stat(p).st_mtime)
+        for path in paths[:len(paths) - ANALYSIS_CACHE_MAX_FILES]:
+            os.remove(path)
+    except OSError as e:
+        logger.warning(f"Could not prune analysis cache: {e}")
+
+
+def discard_analysis(file_path: str):
+    # Drops the cached analysis of a bot file that is about to be removed
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            digest = _analysis_digest(f.read(), file_path)
+    except (OSError, UnicodeDecodeError):
+        return
+    _ANALYSIS_MEMO.pop(digest)
+    try: os.remove(_analysis_cache_path(digest))
+    except OSError: pass
+
+
+def analyze_source(source: str, filename: str) -> CodeAnalysis:
+    digest = _analysis_digest(source, filename)
+    analysis = _ANALYSIS_MEMO.get(digest) or _load_cached_analysis(digest)
+    if analysis is None:
+        try:
+            tree = ast.parse(source, filename)
+        except SyntaxError as e:
+            analysis = CodeAnalysis(False, f"Syntax Error at line {e.lineno}: {e.msg}", frozenset(), False, None)
+        else:
+            imports = set()
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Import):
+                    for alias in node.names:
+                        imports.add(alias.name.split('.')[0])
+                elif isinstance(node, ast.ImportFrom):
+                    if node.module:
+                        imports.add(node.module.split('.')[0])
+            code = compile(tree, filename, "exec", dont_inherit=True)
+            analysis = CodeAnalysis(True, "OK", frozenset(imports), 'application' in source, code)
+        _store_cached_analysis(digest, analysis)
+    _ANALYSIS_MEMO.set(digest, analysis, ANALYSIS_MEMO_TTL)
+    return analysis
+
+
+def analyze_file(file_path: str) -> CodeAnalysis:
+    with open(file_path, "r", encoding="utf-8") as f:
+        return analyze_source(f.read(), file_path)
+
+
+def detect_imports(file_path: str) -> set:
+    return set(analyze_file(file_path).imports)
+
+
+# ==========================================
+# MEMORY ACCOUNTING
+# ==========================================
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def process_rss(pid: int = None) -> int:
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        if pid is None and resource is not None:
+            # Peak rather than current RSS, but better than nothing off Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return 0
+
+
+def start_memory_tracing():
+    if TRACE_MALLOC and not tracemalloc.is_tracing():
+        tracemalloc.start(TRACE_FRAMES)
+        logger.info(f"tracemalloc enabled ({TRACE_FRAMES} frames)")
+
+
+def fmt_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+def memory_report(bots: Dict[str, Dict[str, Any]], shard_pids: List[int]) -> str:
+    lines = [f"🧠 <b>Memory</b>\nProcess RSS: {fmt_bytes(process_rss())}"]
+    for i, pid in enumerate(shard_pids):
+        lines.append(f"Shard {i} RSS: {fmt_bytes(process_rss(pid))}")
+    usage = {token: info["load_rss"] for token, info in bots.items()}
+    if tracemalloc.is_tracing():
+        # One pass over all traces, attributing each allocation to the bot
+        # whose file appears in its traceback
+        owners = {info["file_path"]: token for token, info in bots.items()}
+        traced = dict.fromkeys(bots, 0)
+        snapshot = tracemalloc.take_snapshot()
+        for trace in snapshot.traces:
+            for frame in trace.traceback:
+                token = owners.get(frame.filename)
+                if token:
+                    traced[token] += trace.size
+                    break
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append(f"Traced: {fmt_bytes(current)} (peak {fmt_bytes(peak)})")
+        lines.append("\n<b>Per bot (traced allocations):</b>")
+        usage = traced
+    else:
+        lines.append("\n<b>Per bot (RSS growth at load, approx.):</b>")
+    for token, size in sorted(usage.items(), key=lambda kv: kv[1], reverse=True)[:15]:
+        lines.append(f"{token.split(':')[0]}: {fmt_bytes(size)}")
+    if not usage:
+        lines.append("No bots loaded in this process.")
+    return "\n".join(lines)
+
+
+# ==========================================
+# BOT MANAGER
+# ==========================================
+STDLIB_MODULES = set(getattr(sys, "stdlib_module_names", ())) | set(sys.builtin_module_names) | {
+    'os', 'sys', 'asyncio', 'logging', 'json', 're', 'typing', 'datetime',
+    'time', 'random', 'math', 'collections', 'itertools', 'functools',
+    'pathlib', 'io', 'hashlib', 'base64', 'urllib', 'http', 'html',
+    'sqlite3', 'pickle', 'copy', 'threading', 'contextlib', 'string'
+}
+
+# Package Mapping
+PACKAGE_MAP = {
+    'telegram': 'python-telegram-bot',
+    'PIL': 'Pillow',
+    'cv2': 'opencv-python',
+    'sklearn': 'scikit-learn',
+    'yaml': 'pyyaml',
+    'bs4': 'beautifulsoup4',
+    'requests': 'requests',
+    'numpy': 'numpy',
+    'google': 'google-generativeai', 
+    'google.generativeai': 'google-generativeai'
+}
+
+# Shared resolution cache: packages known to be installed, and recent failures
+# (package -> (monotonic time, error)) that are not retried until INSTALL_RETRY_AFTER
+INSTALLED_PACKAGES: set = set()
+FAILED_PACKAGES: Dict[str, Tuple[float, str]] = {}
+_install_locks: Dict[str, asyncio.Lock] = {}
+_install_slots = asyncio.Semaphore(INSTALL_CONCURRENCY)
+
+
+def _is_distribution_installed(dist: str) -> bool:
+    try:
+        importlib.metadata.version(dist)
+        return True
+    except importlib.metadata.PackageNotFoundError:
+        return False
+
+
+async def _pip_install(pkg: str) -> Tuple[bool, str]:
+    logger.info(f"Installing: {pkg}")
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "pip", "install", pkg,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+    except Exception as e:
+        return False, str(e)
+    try:
+        _, stderr = await asyncio.wait_for(proc.communicate(), timeout=INSTALL_TIMEOUT)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return False, "Installation timed out"
+    if proc.returncode != 0:
+        return False, stderr.decode(errors="replace")[:200]
+    importlib.invalidate_caches()
     return True, "OK"
 
 
-async def validate_bot_token(token: str) -> Tuple[bool, Optional[str], Optional[str]]:
+async def ensure_package(pkg: str) -> Tuple[bool, str]:
+    if pkg in INSTALLED_PACKAGES:
+        return True, "OK"
+    lock = _install_locks.setdefault(pkg, asyncio.Lock())
+    async with lock:
+        if pkg in INSTALLED_PACKAGES:
+            return True, "OK"
+        failed = FAILED_PACKAGES.get(pkg)
+        if failed and time.monotonic() - failed[0] < INSTALL_RETRY_AFTER:
+            return False, failed[1]
+        dist = re.split(r"[<>=!~\[ ]", pkg, maxsplit=1)[0]
+        if await asyncio.to_thread(_is_distribution_installed, dist):
+            INSTALLED_PACKAGES.add(pkg)
+            return True, "OK"
+        async with _install_slots:
+            ok, msg = await _pip_install(pkg)
+        if ok:
+            INSTALLED_PACKAGES.add(pkg)
+            FAILED_PACKAGES.pop(pkg, None)
+        else:
+            FAILED_PACKAGES[pkg] = (time.monotonic(), msg)
+        return ok, msg
+
+
+async def install_dependencies(file_path: str) -> Tuple[bool, str]:
+    imports = await asyncio.to_thread(detect_imports, file_path)
+    packages = {PACKAGE_MAP.get(lib, lib) for lib in imports if lib not in STDLIB_MODULES}
+    results = await asyncio.gather(*(ensure_package(pkg) for pkg in sorted(packages)))
+    for ok, msg in results:
+        if not ok:
+            return False, msg
+    return True, "OK"
+
+
+TOKEN_CACHE = TTLCache(TOKEN_CACHE_SIZE)
+_token_lookups = SingleFlight()
+
+
+async def _fetch_bot_info(token: str) -> Tuple[Tuple[bool, Optional[str], Optional[str]], Optional[float]]:
+    # Returns the validation result and how long it may be cached (None: don't cache)
     try:
-        async with ClientSession(timeout=ClientTimeout(total=10)) as session:
-            async with session.get(f"https://api.telegram.org/bot{token}/getMe") as resp:
+        async with timed_call("telegram.getMe"):
+            url = f"{TELEGRAM_API_URL}/bot{token}/getMe"
+            async with get_http_session().get(url, timeout=ClientTimeout(total=10)) as resp:
                 if resp.status == 200:
                     data = await resp.json()
                     if data.get("ok"):
                         info = data["result"]
-                        return True, info.get("username"), info.get("first_name")
-                return False, None, None
+                        return (True, info.get("username"), info.get("first_name")), TOKEN_CACHE_TTL
+                # 401/404 mean Telegram rejected the token itself
+                return (False, None, None), (TOKEN_NEGATIVE_TTL if resp.status in (401, 404) else None)
     except Exception as e:
         logger.error(f"Token validation error: {e}")
-        return False, None, None
+        return (False, None, None), None
 
 
-async def start_user_bot(token: str, file_path: str) -> Tuple[bool, str]:
+async def validate_bot_token(token: str) -> Tuple[bool, Optional[str], Optional[str]]:
+    cached = TOKEN_CACHE.get(token)
+    if cached is not None:
+        return cached
+
+    async def lookup():
+        result, ttl = await _fetch_bot_info(token)
+        if ttl:
+            TOKEN_CACHE.set(token, result, ttl)
+        return result
+
+    return await _token_lookups.do(token, lookup)
+
+
+class BotLoadError(Exception):
+    pass
+
+
+_module_seq = itertools.count(1)
+
+
+_collect_scheduled = False
+
+
+def _collect_soon():
+    # One full collection per burst of unloads (e.g. an eviction pass) rather
+    # than one per module, run after the burst instead of inline
+    global _collect_scheduled
+    if _collect_scheduled:
+        return
+
+    def collect():
+        global _collect_scheduled
+        _collect_scheduled = False
+        gc.collect()
+
+    _collect_scheduled = True
+    asyncio.get_running_loop().call_later(UNLOAD_GC_DELAY, collect)
+
+
+def _unload_module(module_name: Optional[str]):
+    module = sys.modules.pop(module_name, None) if module_name else None
+    if module is not None:
+        # Drop the module's globals (handlers, application, caches) so nothing
+        # keeps the old code alive once the application has shut down
+        module.__dict__.clear()
+        _collect_soon()
+
+
+async def load_user_app(token: str, file_path: str) -> Tuple[Application, str]:
+    # Installs dependencies, executes the bot module and initializes/starts its
+    # Application. On failure everything loaded so far is torn down again.
+    success, msg = await install_dependencies(file_path)
+    if not success:
+        raise BotLoadError(f"Dependency error: {msg}")
+    
+    analysis = await asyncio.to_thread(analyze_file, file_path)
+    if not analysis.valid:
+        raise BotLoadError(f"Code error: {analysis.error}")
+    
+    # Unique even for two loads in the same second (hot reload runs old and new side by side)
+    module_name = f"userbot_{token[:10]}_{int(time.time())}_{next(_module_seq)}"
+    spec = importlib.util.spec_from_file_location(module_name, file_path)
+    if spec is None or spec.loader is None:
+        raise BotLoadError("Failed to load module")
+    rss_before = process_rss()
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    user_app = None
     try:
-        if token in ACTIVE_BOTS:
-            await stop_user_bot(token)
-        success, msg = await install_dependencies(file_path)
-        if not success:
-            return False, f"Dependency error: {msg}"
-        
-        module_name = f"userbot_{token[:10]}_{int(time.time())}"
-        spec = importlib.util.spec_from_file_location(module_name, file_path)
-        if spec is None or spec.loader is None:
-            return False, "Failed to load module"
-        module = importlib.util.module_from_spec(spec)
-        sys.modules[module_name] = module
-        
+        loading = _loading_bot.set(token), _loading_module.set(module_name)
         try:
-            spec.loader.exec_module(module)
+            # Runs the cached code object instead of recompiling the source
+            exec(analysis.code, module.__dict__)
         except Exception as e:
-            return False, f"Code error: {str(e)[:100]}"
+            raise BotLoadError(f"Code error: {str(e)[:100]}")
+        finally:
+            _loading_bot.reset(loading[0])
+            _loading_module.reset(loading[1])
             
         if not hasattr(module, 'application'):
-            return False, "Code must define 'application' variable"
+            raise BotLoadError("Code must define 'application' variable")
             
         user_app = module.application
         
-        # Test Connection
+        # Fail fast on tokens already known to be rejected; otherwise
+        # initialize() performs the only getMe and its result is cached
+        cached = TOKEN_CACHE.peek(user_app.bot.token)
+        if cached is not None and not cached[0]:
+            raise BotLoadError("Connection Failed: token was rejected by Telegram")
         try:
-            me = await user_app.bot.get_me()
-            logger.info(f"Bot connected: @{me.username}")
+            await user_app.initialize()
         except Exception as conn_err:
-            return False, f"Connection Failed: {conn_err}"
-
-        await user_app.initialize()
+            raise BotLoadError(f"Connection Failed: {conn_err}")
+        if isinstance(user_app.persistence, PlatformPersistence):
+            user_app.persistence.release_rows()
+        me = user_app.bot.bot
+        TOKEN_CACHE.set(user_app.bot.token, (True, me.username, me.first_name), TOKEN_CACHE_TTL)
+        logger.info(f"Bot connected: @{me.username}")
         await user_app.start()
+    except BaseException:
+        await unload_user_app(user_app, module_name)
+        raise
+    BOT_MEMORY[token] = {"file_path": file_path, "load_rss": max(0, process_rss() - rss_before)}
+    return user_app, module_name
+
+
+async def unload_user_app(app: Optional[Application], module_name: Optional[str]):
+    if app is not None:
+        try:
+            if app.running:
+                await app.stop()
+            await app.shutdown()
+        except Exception as e:
+            logger.error(f"Error shutting down {module_name}: {e}")
+    _unload_module(module_name)
+
+
+_BOT_LOCKS: Dict[str, asyncio.Lock] = {}
+
+
+def bot_lock(token: str) -> asyncio.Lock:
+    # Serializes start/reload/stop/activate/evict of one bot, so a double-tapped
+    # restart can't leave two live Applications for the same token
+    lock = _BOT_LOCKS.get(token)
+    if lock is None:
+        lock = _BOT_LOCKS[token] = asyncio.Lock()
+    return lock
+
+
+async def start_user_bot(token: str, file_path: str) -> Tuple[bool, str]:
+    async with bot_lock(token):
+        return await _start_user_bot(token, file_path)
+
+
+async def reload_user_bot(token: str, file_path: str) -> Tuple[bool, str]:
+    async with bot_lock(token):
+        return await _reload_user_bot(token, file_path)
+
+
+async def stop_user_bot(token: str) -> Tuple[bool, str]:
+    async with bot_lock(token):
+        return await _stop_user_bot(token)
+
+
+async def _start_user_bot(token: str, file_path: str) -> Tuple[bool, str]:
+    if WORKER_POOL is not None:
+        ok, msg = await WORKER_POOL.start_bot(token, file_path)
+        if ok and POLLER:
+            POLLER.add(token)
+        return ok, msg
+    if DORMANT_BOTS.pop(token, None) is not None or (token in DISPATCHERS and token not in ACTIVE_BOTS):
+        # Explicit start supersedes on-demand activation
+        await stop_dispatcher(token)
+    if token in ACTIVE_BOTS and token in DISPATCHERS:
+        # Redeploy of a running bot: swap the code without touching the webhook
+        return await _reload_user_bot(token, file_path)
+    try:
+        if token in ACTIVE_BOTS:
+            await _stop_user_bot(token)
+        try:
+            user_app, module_name = await load_user_app(token, file_path)
+        except BotLoadError as e:
+            return False, str(e)
         
         webhook_url = f"{RENDER_EXTERNAL_URL}/bot/{token}"
         try:
-            await user_app.bot.set_webhook(url=webhook_url)
+            if INGESTION_MODE == "polling":
+                # getUpdates is refused while a webhook is set
+                await user_app.bot.delete_webhook()
+            else:
+                await user_app.bot.set_webhook(url=webhook_url)
         except Exception as wh_err:
+            await unload_user_app(user_app, module_name)
+            BOT_MEMORY.pop(token, None)
             return False, f"Webhook Failed: {wh_err}"
         
         ACTIVE_BOTS[token] = user_app
-        update_bot_status(token, "running")
+        BOT_MODULES[token] = module_name
+        start_dispatcher(token, user_app)
+        if POLLER:
+            POLLER.add(token)
+        await db.update_bot_status(token, "running")
         logger.info(f"Started bot: {token[:15]}...")
         return True, "Bot started successfully"
     except Exception as e:
         error_msg = f"{type(e).__name__}: {str(e)[:100]}"
         logger.error(f"Failed to start bot: {error_msg}")
-        update_bot_status(token, "error", error_msg)
+        await db.update_bot_status(token, "error", error_msg)
         return False, error_msg
 
 
-async def stop_user_bot(token: str) -> Tuple[bool, str]:
+async def _reload_user_bot(token: str, file_path: str) -> Tuple[bool, str]:
+    # Zero-downtime restart: the new module is loaded next to the running one,
+    # updates buffer in the bot's queue during the switch, and the webhook
+    # (same URL) is left registered
+    if WORKER_POOL is not None:
+        return await WORKER_POOL.reload_bot(token, file_path)
+    old_app = ACTIVE_BOTS.get(token)
+    dispatcher = DISPATCHERS.get(token)
+    if old_app is None or dispatcher is None:
+        return await _start_user_bot(token, file_path)
+    started = time.perf_counter()
+    # Install up front so the pause only covers executing and starting the new code
+    success, msg = await install_dependencies(file_path)
+    if not success:
+        return False, f"Dependency error: {msg}"
+    # The new instance loads its state during initialize(): hold updates and
+    # hand over the old instance's latest changes first
+    await dispatcher.pause(STOP_DRAIN_TIMEOUT)
+    try:
+        try:
+            await old_app.update_persistence()
+        except Exception as e:
+            logger.error(f"Persisting state before reload failed for {token[:15]}...: {e}")
+        try:
+            new_app, module_name = await load_user_app(token, file_path)
+        except Exception as e:
+            # The old version keeps serving
+            return False, str(e) if isinstance(e, BotLoadError) else f"{type(e).__name__}: {str(e)[:100]}"
+        # Retire whatever is registered now, not the app seen before the awaits
+        old_app, old_module = ACTIVE_BOTS.get(token), BOT_MODULES.get(token)
+        ACTIVE_BOTS[token] = new_app
+        BOT_MODULES[token] = module_name
+        dispatcher.app = new_app
+    finally:
+        dispatcher.resume()
+    
+    await unload_user_app(old_app, old_module)
+    await db.update_bot_status(token, "running")
+    logger.info(f"Hot-reloaded bot: {token[:15]}... in {time.perf_counter() - started:.2f}s")
+    return True, "Bot reloaded"
+
+
+def activate_dormant_bot(token: str) -> BotDispatcher:
+    # Called from webhook_handler: the returned dispatcher buffers updates
+    # while the bot's module loads in the background
+    file_path = DORMANT_BOTS.pop(token)
+    dispatcher = start_dispatcher(token, None)
+    task = asyncio.create_task(_activate(token, file_path, dispatcher))
+    _activations.add(task)
+    task.add_done_callback(_activations.discard)
+    return dispatcher
+
+
+async def _activate(token: str, file_path: str, dispatcher: BotDispatcher):
+    async with bot_lock(token):
+        if DISPATCHERS.get(token) is dispatcher:
+            await _load_activation(token, file_path, dispatcher)
+
+
+async def _load_activation(token: str, file_path: str, dispatcher: BotDispatcher):
+    started = time.perf_counter()
+    try:
+        app, module_name = await load_user_app(token, file_path)
+    except Exception as e:
+        logger.error(f"Activation failed for {token[:15]}...: {e}")
+        if DISPATCHERS.get(token) is dispatcher:
+            await stop_dispatcher(token)
+        await db.update_bot_status(token, "error", str(e)[:200])
+        return
+    if DISPATCHERS.get(token) is not dispatcher:
+        # Stopped or restarted while loading
+        await unload_user_app(app, module_name)
+        return
+    ACTIVE_BOTS[token] = app
+    BOT_MODULES[token] = module_name
+    dispatcher.app = app
+    dispatcher.resume()
+    logger.info(f"Activated bot {token[:15]}... in {time.perf_counter() - started:.2f}s")
+
+
+async def evict_bot(token: str):
+    async with bot_lock(token):
+        await _evict_bot(token)
+
+
+async def _evict_bot(token: str):
+    # Back to dormant: detach everything synchronously so an update arriving
+    # meanwhile starts a fresh activation, then tear the old instance down
+    dispatcher = DISPATCHERS.pop(token, None)
+    app = ACTIVE_BOTS.pop(token, None)
+    module_name = BOT_MODULES.pop(token, None)
+    memory = BOT_MEMORY.pop(token, None)
+    if app is None or memory is None:
+        return
+    DORMANT_BOTS[token] = memory["file_path"]
+    if dispatcher:
+        await dispatcher.stop(STOP_DRAIN_TIMEOUT)
+    await unload_user_app(app, module_name)
+    logger.info(f"Evicted idle bot {token[:15]}...")
+
+
+async def idle_evictor():
+    while True:
+        await asyncio.sleep(EVICT_CHECK_INTERVAL)
+        now = time.monotonic()
+        loaded = sorted(
+            (d.last_update, token) for token, d in DISPATCHERS.items()
+            if token in ACTIVE_BOTS and d.queue.empty() and not d._active
+        )
+        excess = max(0, len(ACTIVE_BOTS) - LAZY_MAX_ACTIVE) if LAZY_MAX_ACTIVE else 0
+        for i, (last_update, token) in enumerate(loaded):
+            if i < excess or now - last_update >= IDLE_EVICT_SECONDS:
+                try: await evict_bot(token)
+                except Exception as e: logger.error(f"Eviction failed for {token[:15]}...: {e}")
+
+
+_activations: set = set()
+
+
+async def _stop_user_bot(token: str) -> Tuple[bool, str]:
+    UPDATE_WINDOWS.pop(token, None)
+    RESTORING_BOTS.pop(token, None)
+    forget_bot_request_state(token)
+    if POLLER:
+        POLLER.remove(token)
+    if WORKER_POOL is not None:
+        return await WORKER_POOL.stop_bot(token)
     try:
         if token in ACTIVE_BOTS:
             app = ACTIVE_BOTS[token]
             try:
                 await app.bot.delete_webhook()
             except: pass
-            await app.stop()
-            await app.shutdown()
+            await stop_dispatcher(token, STOP_DRAIN_TIMEOUT)
             del ACTIVE_BOTS[token]
-        update_bot_status(token, "stopped")
+            await unload_user_app(app, BOT_MODULES.pop(token, None))
+            BOT_MEMORY.pop(token, None)
+        elif DORMANT_BOTS.pop(token, None) is not None or token in DISPATCHERS:
+            await stop_dispatcher(token)
+            try:
+                async with timed_call("telegram.deleteWebhook"):
+                    url = f"{TELEGRAM_API_URL}/bot{token}/deleteWebhook"
+                    async with get_http_session().post(url, timeout=ClientTimeout(total=10)) as resp:
+                        await resp.read()
+            except: pass
+        await db.update_bot_status(token, "stopped")
         return True, "Bot stopped"
     except Exception as e:
         return False, str(e)
 
 
+# ==========================================
+# PROCESS ISOLATION
+# ==========================================
+# In EXECUTION_MODE=process hosted bots are sharded across WORKER_PROCESSES
+# worker processes, each with its own event loop. The main process keeps the
+# platform bot and the webhook server, and forwards updates to the owning
+# shard over a Unix socket using length-prefixed JSON frames.
+_FRAME_HEADER = struct.Struct("!I")
+
+
+def _encode_frame(msg: Dict[str, Any]) -> bytes:
+    body = json.dumps(msg, separators=(",", ":")).encode()
+    return _FRAME_HEADER.pack(len(body)) + body
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> Optional[Dict[str, Any]]:
+    try:
+        header = await reader.readexactly(_FRAME_HEADER.size)
+        body = await reader.readexactly(_FRAME_HEADER.unpack(header)[0])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return json.loads(body)
+
+
+def _worker_process_main(index: int, sock_path: str):
+    global logger
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger = logging.getLogger(f"{__name__}.shard{index}")
+    start_memory_tracing()
+    asyncio.run(_worker_serve(sock_path))
+
+
+async def _worker_serve(sock_path: str):
+    closed = asyncio.Event()
+    commands = set()
+    # Updates the parent acknowledged while their bot's queue was full, held
+    # per bot so one slow bot never stalls the socket for the rest of the shard
+    overflow: Dict[str, deque] = {}
+    draining: Dict[str, asyncio.Task] = {}
+
+    async def drain_overflow(token: str, dispatcher: BotDispatcher, writer: asyncio.StreamWriter):
+        backlog = overflow[token]
+        try:
+            while backlog:
+                await dispatcher.put(backlog.popleft())
+        finally:
+            overflow.pop(token, None)
+            draining.pop(token, None)
+            if not writer.is_closing():
+                writer.write(_encode_frame({"op": "ready", "token": token}))
+
+    def hold_update(token: str, dispatcher: BotDispatcher, data: dict, writer: asyncio.StreamWriter):
+        backlog = overflow.get(token)
+        if backlog is None:
+            if UPDATE_OVERFLOW_POLICY != "reject" or not dispatcher.queue.full():
+                dispatcher.submit(data)
+                return
+            # The parent answers 503 for this bot until the backlog drains
+            backlog = overflow[token] = deque()
+            writer.write(_encode_frame({"op": "full", "token": token}))
+            draining[token] = asyncio.create_task(drain_overflow(token, dispatcher, writer))
+        backlog.append(data)
+
+    async def run_command(msg: Dict[str, Any], writer: asyncio.StreamWriter):
+        if msg["op"] == "stop" and msg["token"] in draining:
+            draining[msg["token"]].cancel()
+        if msg["op"] == "start":
+            ok, text = await start_user_bot(msg["token"], msg["file_path"])
+        elif msg["op"] == "reload":
+            ok, text = await reload_user_bot(msg["token"], msg["file_path"])
+        elif msg["op"] == "stop":
+            ok, text = await stop_user_bot(msg["token"])
+        elif msg["op"] == "metrics":
+            ok, text = True, json.dumps(bot_metrics_snapshot(), separators=(",", ":"))
+        else:
+            ok, text = False, f"Unknown op {msg['op']}"
+        writer.write(_encode_frame({"id": msg["id"], "ok": ok, "msg": text}))
+        await writer.drain()
+
+    async def on_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                msg = await _read_frame(reader)
+                if msg is None:
+                    break
+                if msg["op"] == "update":
+                    dispatcher = DISPATCHERS.get(msg["token"])
+                    if dispatcher:
+                        hold_update(msg["token"], dispatcher, msg["data"], writer)
+                else:
+                    task = asyncio.create_task(run_command(msg, writer))
+                    commands.add(task)
+                    task.add_done_callback(commands.discard)
+        finally:
+            closed.set()
+
+    server = await asyncio.start_unix_server(on_connect, path=sock_path)
+    try:
+        await closed.wait()
+    finally:
+        server.close()
+        await shutdown_platform()
+
+
+class WorkerShard:
+    def __init__(self, index: int, sock_path: str):
+        self.index = index
+        self.sock_path = sock_path
+        self.process = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.tokens: Dict[str, str] = {}  # token -> file_path of bots owned by this shard
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_id = 0
+        self._reader_task: Optional[asyncio.Task] = None
+        self._respawn_task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.full: set = set()  # tokens whose queue in the worker is full; route() refuses them
+
+    async def start(self):
+        if os.path.exists(self.sock_path):
+            os.remove(self.sock_path)
+        ctx = multiprocessing.get_context("spawn")
+        self.process = ctx.Process(
+            target=_worker_process_main, args=(self.index, self.sock_path),
+            name=f"bot-shard-{self.index}", daemon=True
+        )
+        self.process.start()
+        for _ in range(WORKER_START_TIMEOUT * 10):
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.sock_path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if not self.process.is_alive():
+                    raise RuntimeError(f"Shard {self.index} exited during startup")
+                await asyncio.sleep(0.1)
+        else:
+            raise RuntimeError(f"Shard {self.index} did not start")
+        self._reader_task = asyncio.create_task(self._read_loop(reader))
+        logger.info(f"Shard {self.index} started (pid {self.process.pid})")
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        while True:
+            msg = await _read_frame(reader)
+            if msg is None:
+                break
+            if msg.get("op") == "full":
+                self.full.add(msg["token"])
+                continue
+            if msg.get("op") == "ready":
+                self.full.discard(msg["token"])
+                continue
+            fut = self._pending.pop(msg["id"], None)
+            if fut and not fut.done():
+                fut.set_result((msg["ok"], msg["msg"]))
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_result((False, "Worker process exited"))
+        self._pending.clear()
+        self.full.clear()
+        if not self._stopping:
+            self._respawn_task = asyncio.create_task(self._respawn())
+
+    async def _respawn(self):
+        logger.error(f"Shard {self.index} died, respawning with {len(self.tokens)} bots")
+        owned, self.tokens = self.tokens, {}
+        for token in owned:
+            REMOTE_BOTS.pop(token, None)
+        try:
+            await self.start()
+        except Exception as e:
+            logger.error(f"Shard {self.index} respawn failed, {len(owned)} bots offline: {e}")
+            return
+        for token, file_path in owned.items():
+            ok, msg = await self.start_bot(token, file_path)
+            if not ok:
+                logger.error(f"Shard {self.index} could not restart {token[:15]}...: {msg}")
+
+    async def call(self, op: str, timeout: float, **fields) -> Tuple[bool, str]:
+        self._next_id += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[self._next_id] = fut
+        self.writer.write(_encode_frame({"op": op, "id": self._next_id, **fields}))
+        try:
+            return await asyncio.wait_for(fut, timeout=timeout)
+        except asyncio.TimeoutError:
+            return False, f"Worker {op} timed out"
+
+    def route(self, token: str, data: dict) -> bool:
+        # Returns False if the bot or the whole shard is not keeping up and Telegram should retry
+        if token in self.full or self.writer.transport.get_write_buffer_size() > WORKER_MAX_BACKLOG:
+            return False
+        self.writer.write(_encode_frame({"op": "update", "token": token, "data": data}))
+        return True
+
+    async def start_bot(self, token: str, file_path: str) -> Tuple[bool, str]:
+        ok, msg = await self.call("start", INSTALL_TIMEOUT + 60, token=token, file_path=file_path)
+        if ok:
+            self.tokens[token] = file_path
+            REMOTE_BOTS[token] = self
+        return ok, msg
+
+    async def reload_bot(self, token: str, file_path: str) -> Tuple[bool, str]:
+        ok, msg = await self.call("reload", INSTALL_TIMEOUT + 60, token=token, file_path=file_path)
+        if ok:
+            self.tokens[token] = file_path
+            REMOTE_BOTS[token] = self
+        return ok, msg
+
+    async def stop_bot(self, token: str) -> Tuple[bool, str]:
+        self.tokens.pop(token, None)
+        self.full.discard(token)
+        REMOTE_BOTS.pop(token, None)
+        return await self.call("stop", STOP_DRAIN_TIMEOUT + 30, token=token)
+
+    async def stop(self):
+        self._stopping = True
+        if self.writer:
+            self.writer.close()
+        if self.process:
+            await asyncio.to_thread(self.process.join, 30)
+            if self.process.is_alive():
+                self.process.terminate()
+
+
+class WorkerPool:
+    def __init__(self, size: int):
+        self._dir = tempfile.mkdtemp(prefix="hostkaro-")
+        self.shards = [WorkerShard(i, os.path.join(self._dir, f"shard{i}.sock")) for i in range(size)]
+
+    async def start(self):
+        await asyncio.gather(*(shard.start() for shard in self.shards))
+
+    def shard_for(self, token: str) -> WorkerShard:
+        return self.shards[zlib.crc32(token.encode()) % len(self.shards)]
+
+    async def start_bot(self, token: str, file_path: str) -> Tuple[bool, str]:
+        return await self.shard_for(token).start_bot(token, file_path)
+
+    async def reload_bot(self, token: str, file_path: str) -> Tuple[bool, str]:
+        return await self.shard_for(token).reload_bot(token, file_path)
+
+    async def stop_bot(self, token: str) -> Tuple[bool, str]:
+        return await self.shard_for(token).stop_bot(token)
+
+    async def metrics(self) -> List[Dict[str, Any]]:
+        # A shard that is respawning or slow to answer is left out of this scrape
+        results = await asyncio.gather(*(shard.call("metrics", METRICS_SHARD_TIMEOUT) for shard in self.shards if shard.writer))
+        return [json.loads(text) for ok, text in results if ok]
+
+    async def stop(self):
+        await asyncio.gather(*(shard.stop() for shard in self.shards))
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+REMOTE_BOTS: Dict[str, WorkerShard] = {}
+WORKER_POOL: Optional[WorkerPool] = None
+
+
+def is_bot_active(token: str) -> bool:
+    return token in ACTIVE_BOTS or token in REMOTE_BOTS or token in DORMANT_BOTS
+
+
+def active_bot_count() -> int:
+    return len(ACTIVE_BOTS) + len(REMOTE_BOTS)
+
+
+# ==========================================
+# LONG POLLING
+# ==========================================
+# In INGESTION_MODE=polling a single task multiplexes getUpdates for every
+# bot over one connection pool and feeds results through ingest_update(),
+# the same path webhook_handler uses. Bots that just had traffic are polled
+# again at once with a long timeout; idle bots fall back to short polls with
+# exponential backoff only when there are more bots than poll slots. The
+# slot count grows while bots wait for one and halves on errors.
+class PollMultiplexer:
+    def __init__(self):
+        self.offsets: Dict[str, int] = {}
+        self.idle: Dict[str, int] = {}
+        self.due: Dict[str, float] = {}
+        self.inflight: Dict[asyncio.Task, str] = {}
+        self.limit = POLL_MIN_CONCURRENCY
+        self.polls = 0
+        self.updates = 0
+        self.errors = 0
+        self._last_adjust = 0.0
+        self._wakeup = asyncio.Event()
+        self._session: Optional[ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        # Own connector so held long polls cannot starve other outbound calls
+        self._session = ClientSession(connector=TCPConnector(
+            limit=POLL_MAX_CONCURRENCY, ttl_dns_cache=HTTP_DNS_TTL, keepalive_timeout=HTTP_KEEPALIVE
+        ))
+        self._task = asyncio.create_task(self._run())
+
+    def add(self, token: str):
+        if token not in self.due:
+            self.offsets.setdefault(token, 0)
+            self.idle[token] = 0
+            self.due[token] = 0.0
+            self._wakeup.set()
+
+    def remove(self, token: str):
+        self.due.pop(token, None)
+        self.idle.pop(token, None)
+        self.offsets.pop(token, None)
+        for task, polled in list(self.inflight.items()):
+            if polled == token:
+                task.cancel()
+
+    def stats(self) -> Dict[str, int]:
+        return {"bots": len(self.due), "inflight": len(self.inflight), "limit": self.limit,
+                "polls": self.polls, "updates": self.updates, "errors": self.errors}
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            for task in [t for t in self.inflight if t.done()]:
+                self._finish(self.inflight.pop(task), task)
+            now = time.monotonic()
+            ready = sorted((at, token) for token, at in self.due.items() if at <= now)
+            free = self.limit - len(self.inflight)
+            for _, token in ready[:max(free, 0)]:
+                long_poll = self.idle[token] == 0 or len(self.due) <= self.limit
+                self.due[token] = float("inf")
+                task = asyncio.create_task(self._fetch(token, POLL_TIMEOUT if long_poll else 0))
+                task.add_done_callback(lambda _: self._wakeup.set())
+                self.inflight[task] = token
+            if len(ready) > free:
+                self._adjust(now, grow=True)
+            pending = [at for at in self.due.values() if at != float("inf")]
+            delay = max(0.0, min(pending) - now) if pending and len(ready) <= free else None
+            try: await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError: pass
+
+    def _adjust(self, now: float, grow: bool):
+        if now - self._last_adjust < 1:
+            return
+        self._last_adjust = now
+        if grow:
+            self.limit = min(POLL_MAX_CONCURRENCY, self.limit + max(1, self.limit // 4))
+        else:
+            self.limit = max(POLL_MIN_CONCURRENCY, self.limit // 2)
+
+    async def _fetch(self, token: str, timeout: int) -> List[dict]:
+        url = f"{TELEGRAM_API_URL}/bot{token}/getUpdates"
+        params = {"offset": self.offsets.get(token, 0), "timeout": timeout, "limit": 100}
+        async with self._session.get(url, params=params, timeout=ClientTimeout(total=timeout + 15)) as resp:
+            body = await resp.json(content_type=None)
+        self.polls += 1
+        if not body.get("ok"):
+            code = body.get("error_code")
+            if code == 409:
+                # A webhook is still registered from webhook mode
+                async with self._session.post(f"{TELEGRAM_API_URL}/bot{token}/deleteWebhook") as resp:
+                    await resp.read()
+            raise PollError(code, body.get("description", ""), (body.get("parameters") or {}).get("retry_after"))
+        return body.get("result") or []
+
+    def _finish(self, token: str, task: asyncio.Task):
+        if token not in self.due or task.cancelled():
+            return
+        now = time.monotonic()
+        error = task.exception()
+        if error is not None:
+            self.errors += 1
+            self._adjust(now, grow=False)
+            if isinstance(error, PollError) and error.code in (401, 404):
+                logger.error(f"Polling stopped for {token[:15]}...: {error}")
+                self.remove(token)
+                return
+            retry_after = getattr(error, "retry_after", None)
+            self.idle[token] += 1
+            self.due[token] = now + (retry_after or min(POLL_IDLE_MAX_DELAY, 2 ** self.idle[token]))
+            if not isinstance(error, PollError) or error.code != 409:
+                logger.warning(f"getUpdates failed for {token[:15]}...: {type(error).__name__}: {error}")
+            return
+        updates = task.result()
+        for data in updates:
+            accepted = ingest_update(token, data)
+            if accepted is None:
+                self.remove(token)
+                return
+            if accepted is False:
+                # Queue full: leave the rest unconfirmed and come back shortly
+                self.due[token] = now + 1
+                return
+            self.offsets[token] = data["update_id"] + 1
+            self.updates += 1
+        if updates:
+            self.idle[token] = 0
+            self.due[token] = now
+        else:
+            self.idle[token] += 1
+            crowded = len(self.due) > self.limit
+            self.due[token] = now + min(POLL_IDLE_MAX_DELAY, 0.5 * 2 ** self.idle[token]) if crowded else now
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        for task in self.inflight:
+            task.cancel()
+        await asyncio.gather(*self.inflight, return_exceptions=True)
+        self.inflight.clear()
+        if self._session:
+            await self._session.close()
+
+
+class PollError(Exception):
+    def __init__(self, code: Optional[int], description: str, retry_after: Optional[int] = None):
+        super().__init__(f"{code}: {description}")
+        self.code = code
+        self.retry_after = retry_after
+
+
+POLLER: Optional[PollMultiplexer] = None
+
+
 # ==========================================
 # NON-TECHNICAL AI ENGINE
 # ==========================================
-async def consult_gemini_analyst(current_info: str, history: List[Dict]) -> Dict[str, Any]:
-    if not GEMINI_API_KEY:
-        return {"question": "System Error: API Key missing.", "options": ["Contact Admin"], "refined_summary": current_info}
+GEMINI_USAGE: Dict[str, int] = {"calls": 0, "cache_hits": 0, "prompt_tokens": 0, "output_tokens": 0}
+_gemini_flights = SingleFlight()
+
+
+def record_gemini_usage(kind: str, result: Dict[str, Any], elapsed: float):
+    usage = result.get("usageMetadata") or {}
+    prompt_tokens = usage.get("promptTokenCount", 0)
+    output_tokens = usage.get("candidatesTokenCount", 0)
+    GEMINI_USAGE["calls"] += 1
+    GEMINI_USAGE["prompt_tokens"] += prompt_tokens
+    GEMINI_USAGE["output_tokens"] += output_tokens
+    logger.info(f"Gemini {kind}: {elapsed * 1000:.0f}ms, {prompt_tokens} prompt / {output_tokens} output tokens")
+
 
+async def _consult_gemini_uncached(current_info: str, history: List[Dict], cache_key: str) -> Dict[str, Any]:
     prompt = f"""You are a helpful Product Manager helping a user create a Telegram bot.
     Current Idea: {current_info}
     History: {json.dumps(history)}
@@ -418,15 +2897,45 @@ async def consult_gemini_analyst(current_info: str, history: List[Dict]) -> Dict
     }
     
     try:
-        async with ClientSession() as session:
-            async with session.post(GEMINI_API_URL, json=payload, headers=headers) as resp:
-                if resp.status != 200: return {"question": "Ready?", "options": ["Build"], "refined_summary": current_info}
+        started = time.perf_counter()
+        async with timed_call("gemini.consult"):
+            async with get_http_session().post(GEMINI_API_URL, json=payload, headers=headers) as resp:
+                if resp.status != 200:
+                    logger.warning(f"Gemini consult returned HTTP {resp.status}")
+                    return {"question": "Ready?", "options": ["Build"], "refined_summary": current_info}
                 result = await resp.json()
-                if 'candidates' not in result: return {"question": "Build now?", "options": ["Yes"], "refined_summary": current_info}
-                return json.loads(result['candidates'][0]['content']['parts'][0]['text'])
-    except: return {"question": "Build now?", "options": ["Yes"], "refined_summary": current_info}
+        record_gemini_usage("consult", result, time.perf_counter() - started)
+        if 'candidates' not in result: return {"question": "Build now?", "options": ["Yes"], "refined_summary": current_info}
+        text = result['candidates'][0]['content']['parts'][0]['text']
+        answer = json.loads(text)
+    except Exception as e:
+        logger.warning(f"Gemini consult failed: {e}")
+        return {"question": "Build now?", "options": ["Yes"], "refined_summary": current_info}
+    # Only real answers are cached, never the fallbacks above
+    try: await db.put_gemini_cache(cache_key, text)
+    except Exception as e: logger.error(f"Gemini cache write failed: {e}")
+    return answer
+
 
-async def generate_final_code(summary: str, token: str) -> Tuple[Optional[str], Optional[str]]:
+async def consult_gemini_analyst(current_info: str, history: List[Dict]) -> Dict[str, Any]:
+    if not GEMINI_API_KEY:
+        return {"question": "System Error: API Key missing.", "options": ["Contact Admin"], "refined_summary": current_info}
+
+    # Content-addressed: identical idea + conversation => identical question
+    cache_key = hashlib.sha256(
+        json.dumps([GEMINI_API_URL, current_info, history], sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+    try:
+        cached = await db.get_gemini_cache(cache_key)
+    except Exception as e:
+        logger.error(f"Gemini cache read failed: {e}")
+        cached = None
+    if cached is not None:
+        GEMINI_USAGE["cache_hits"] += 1
+        return json.loads(cached)
+    return await _gemini_flights.do(cache_key, lambda: _consult_gemini_uncached(current_info, history, cache_key))
+
+async def generate_final_code(summary: str, token: str, file_path: str, on_progress=None) -> Tuple[Optional[str], Optional[str]]:
     if not GEMINI_API_KEY: return None, "API Key missing"
 
     prompt = f"""You are an expert Python developer. Generate a complete, production-ready Telegram bot.
@@ -451,22 +2960,155 @@ async def generate_final_code(summary: str, token: str) -> Tuple[Optional[str],
     payload = { "contents": [{"parts": [{"text": prompt}]}], "generationConfig": { "temperature": 0.5 } }
     
     try:
-        async with ClientSession() as session:
-            async with session.post(GEMINI_API_URL, json=payload, headers=headers) as resp:
-                result = await resp.json()
-                if 'candidates' not in result: return None, "AI Blocked"
-                content = result['candidates'][0]['content']['parts'][0]['text']
-                code = re.sub(r'^```python\s*\n?', '', content)
-                code = re.sub(r'^```\s*\n?', '', code)
-                code = re.sub(r'\n?```$', '', code).strip()
-                
-                valid, error = validate_python_code(code)
-                if not valid: return None, f"Syntax Error: {error}"
-                if 'application' not in code: return None, "Missing 'application' object"
-                return code, None
+        started = time.perf_counter()
+        if GEMINI_STREAMING:
+            async with timed_call("gemini.generate_stream"):
+                content, result = await _stream_gemini(payload, headers, on_progress)
+        else:
+            async with timed_call("gemini.generate"):
+                async with get_http_session().post(GEMINI_API_URL, json=payload, headers=headers) as resp:
+                    result = await resp.json()
+            content = result['candidates'][0]['content']['parts'][0]['text'] if 'candidates' in result else None
+        record_gemini_usage("generate", result, time.perf_counter() - started)
+        if not content: return None, "AI Blocked"
+        code = re.sub(r'^```python\s*\n?', '', content)
+        code = re.sub(r'^```\s*\n?', '', code)
+        code = re.sub(r'\n?```$', '', code).strip()
+        
+        # Analysed under the path it is saved to, so deploying reuses this parse
+        analysis = await asyncio.to_thread(analyze_source, code, file_path)
+        if not analysis.valid: return None, analysis.error
+        if not analysis.mentions_application: return None, "Missing 'application' object"
+        return code, None
     except Exception as e: return None, str(e)
 
 
+async def _stream_gemini(payload: Dict, headers: Dict, on_progress=None) -> Tuple[Optional[str], Dict[str, Any]]:
+    # Reads the SSE stream from streamGenerateContent, assembling the text as it
+    # arrives; returns the full text and the last chunk (for usageMetadata)
+    parts: List[str] = []
+    last: Dict[str, Any] = {}
+    async with get_http_session().post(GEMINI_STREAM_URL, json=payload, headers=headers) as resp:
+        if resp.status != 200:
+            raise RuntimeError(f"Gemini HTTP {resp.status}: {(await resp.text())[:100]}")
+        async for raw in resp.content:
+            line = raw.decode("utf-8", errors="replace").strip()
+            if not line.startswith("data:"):
+                continue
+            chunk = json.loads(line[5:])
+            last = chunk
+            for candidate in chunk.get("candidates", []):
+                for part in candidate.get("content", {}).get("parts", []):
+                    parts.append(part.get("text", ""))
+            if on_progress and parts:
+                await on_progress("".join(parts))
+    return ("".join(parts) or None), last
+
+
+# ==========================================
+# BROADCAST ENGINE
+# ==========================================
+class BroadcastJob:
+    # Background broadcast: streams recipients from SQLite in keyset-paginated
+    # chunks and sends with bounded concurrency under a global rate limit
+    def __init__(self, broadcast_id: int, text: str, bot, total: int, chat_id: int, message_id: int):
+        self.broadcast_id = broadcast_id
+        self.text = text
+        self.bot = bot
+        self.total = total
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self._limiter = RateLimiter(BROADCAST_RATE, burst=BROADCAST_CONCURRENCY)
+        self._slots = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        self._last_progress = 0.0
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+    def summary(self) -> str:
+        elapsed = (self.finished or time.monotonic()) - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0
+        state = "✅ Finished" if self.finished else "📢 Broadcasting"
+        return (
+            f"{state} #{self.broadcast_id}\n"
+            f"Progress: {self.done}/{self.total}\n"
+            f"Sent: {self.sent} | Blocked: {self.blocked} | Failed: {self.failed}\n"
+            f"Throughput: {rate:.1f} msg/s | Elapsed: {elapsed:.0f}s"
+        )
+
+    async def _send(self, user_id: int) -> Tuple[int, str, Optional[str]]:
+        async with self._slots:
+            for _ in range(BROADCAST_MAX_RETRIES + 1):
+                await self._limiter.acquire()
+                try:
+                    await self.bot.send_message(user_id, self.text)
+                    self.sent += 1
+                    return user_id, "sent", None
+                except RetryAfter as e:
+                    self.retries += 1
+                    delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                    await asyncio.sleep(delay)
+                except Forbidden as e:
+                    self.blocked += 1
+                    return user_id, "blocked", str(e)[:200]
+                except Exception as e:
+                    self.failed += 1
+                    return user_id, "failed", str(e)[:200]
+            self.failed += 1
+            return user_id, "failed", "Too many RetryAfter responses"
+
+    async def _report(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_progress < BROADCAST_PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        try: await self.bot.edit_message_text(self.summary(), chat_id=self.chat_id, message_id=self.message_id)
+        except BadRequest: pass
+        except Exception as e: logger.warning(f"Broadcast progress update failed: {e}")
+
+    async def run(self):
+        global CURRENT_BROADCAST, LAST_BROADCAST_SUMMARY
+        status = "finished"
+        try:
+            after = 0
+            while True:
+                chunk = await db.get_user_ids_after(after, BROADCAST_CHUNK_SIZE)
+                if not chunk:
+                    break
+                after = chunk[-1]
+                results = await asyncio.gather(*(self._send(uid) for uid in chunk))
+                await db.record_broadcast_results(self.broadcast_id, results)
+                await self._report()
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        except Exception as e:
+            status = "error"
+            logger.error(f"Broadcast #{self.broadcast_id} failed: {e}")
+        finally:
+            self.finished = time.monotonic()
+            try: await db.finish_broadcast(self.broadcast_id, status, self.sent, self.blocked + self.failed)
+            except Exception as e: logger.error(f"Failed to record broadcast #{self.broadcast_id}: {e}")
+            if CURRENT_BROADCAST is self:
+                CURRENT_BROADCAST = None
+            LAST_BROADCAST_SUMMARY = self.summary()
+            logger.info(f"Broadcast #{self.broadcast_id} {status}: {self.sent}/{self.total} sent")
+            if status != "cancelled":
+                await self._report(force=True)
+
+
+CURRENT_BROADCAST: Optional[BroadcastJob] = None
+LAST_BROADCAST_SUMMARY: Optional[str] = None
+_broadcast_task: Optional[asyncio.Task] = None
+
+
 # ==========================================
 # HELPER & KEYBOARDS
 # ==========================================
@@ -474,6 +3116,11 @@ def esc(text) -> str:
     if text is None: return ""
     return html.escape(str(text))
 
+def parse_bot_id(callback_data: str) -> Optional[int]:
+    # Callback data is "<action>_<bot_id>"
+    try: return int(callback_data.rsplit("_", 1)[1])
+    except (IndexError, ValueError): return None
+
 def main_menu_kb(user_id) -> ReplyKeyboardMarkup:
     keyboard = [["✨ Create Bot", "📤 Host Bot"], ["📊 My Bots", "🆘 Help"]]
     if user_id == ADMIN_ID: keyboard.append(["🔐 Admin Panel"]) 
@@ -487,7 +3134,7 @@ def back_kb() -> ReplyKeyboardMarkup:
 # ==========================================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
-    save_user(user.id, user.username, user.first_name)
+    await db.save_user(user.id, user.username, user.first_name)
     context.user_data.clear()
     
     if user.id == ADMIN_ID:
@@ -559,15 +3206,18 @@ async def host_get_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     file_path = os.path.join(BOTS_DIR, filename)
     await file.download_to_drive(file_path)
     
-    with open(file_path, 'r') as f: code = f.read()
-    valid, error = validate_python_code(code)
+    try:
+        analysis = await asyncio.to_thread(analyze_file, file_path)
+    except UnicodeDecodeError:
+        analysis = CodeAnalysis(False, "File is not valid UTF-8", frozenset(), False, None)
     
-    if not valid or 'application' not in code:
+    if not analysis.valid or not analysis.mentions_application:
+        discard_analysis(file_path)
         os.remove(file_path)
-        await msg.edit_text(f"❌ Error: {error or 'No application object found'}")
+        await msg.edit_text(f"❌ Error: {analysis.error if not analysis.valid else 'No application object found'}")
         return HOST_GET_FILE
     
-    save_bot(user_id, token, file_path, "upload", context.user_data.get('bot_username'))
+    await db.save_bot(user_id, token, file_path, "upload", context.user_data.get('bot_username'))
     success, res = await start_user_bot(token, file_path)
     
     if success:
@@ -665,23 +3315,36 @@ async def start_build_process(update: Update, context: ContextTypes.DEFAULT_TYPE
     msg_func = update.callback_query.edit_message_text if update.callback_query else update.message.reply_text
     msg = await msg_func("🏗️ <b>Blueprint Complete!</b>\n\nCoding your bot now... (approx 20s)", parse_mode='HTML')
     
-    data = context.user_data['create']
-    code, error = await generate_final_code(data['summary'], data['token'])
+    last_edit = time.monotonic()
+    async def on_progress(text: str):
+        nonlocal last_edit
+        if time.monotonic() - last_edit < BUILD_PROGRESS_INTERVAL: return
+        last_edit = time.monotonic()
+        try: await msg.edit_text(f"🏗️ <b>Blueprint Complete!</b>\n\nCoding your bot now... ✍️ {text.count(chr(10))} lines written", parse_mode='HTML')
+        except BadRequest: pass
+        except Exception as e:
+            # Progress is cosmetic; never let a failed edit abort generation
+            logger.warning(f"Build progress update failed: {e}")
     
-    if error:
-        await msg.edit_text(f"❌ Coding Failed:\n{error}")
-        return
-        
+    data = context.user_data['create']
     user_id = update.effective_user.id
     token = data['token']
     filename = f"{user_id}_{token.split(':')[0]}_ai_{int(time.time())}.py"
     file_path = os.path.join(BOTS_DIR, filename)
+    code, error = await generate_final_code(data['summary'], token, file_path, on_progress)
+    
+    if error:
+        await msg.edit_text(f"❌ Coding Failed:\n{error}")
+        return
     
     with open(file_path, 'w', encoding='utf-8') as f: f.write(code)
-    save_bot(user_id, token, file_path, "ai_generated", data['username'])
+    # Start resolving imports right away; start_user_bot joins the same per-package installs
+    prefetch = asyncio.create_task(install_dependencies(file_path))
+    await db.save_bot(user_id, token, file_path, "ai_generated", data['username'])
     
     await msg.edit_text("🚀 Deploying to server...", parse_mode='HTML')
     success, res = await start_user_bot(token, file_path)
+    await asyncio.gather(prefetch, return_exceptions=True)
     
     if success:
         await msg.edit_text(f"🎉 <b>Bot Launched!</b>\n\n🤖 @{data['username']}\nStatus: 🟢 Online\n\nTry sending /start to it!", parse_mode='HTML')
@@ -693,40 +3356,40 @@ async def start_build_process(update: Update, context: ContextTypes.DEFAULT_TYPE
 # ==========================================
 async def my_bots(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    bots = get_user_bots(user_id)
+    bots = await db.get_user_bots(user_id)
     if not bots:
         await update.message.reply_text("📭 You have 0 bots.", reply_markup=main_menu_kb(user_id))
         return MAIN_MENU
     text = "📊 <b>Your Bots:</b>\n"
     buttons = []
     for bot in bots:
-        status = "🟢" if bot['token'] in ACTIVE_BOTS else "🔴"
+        status = "🟢" if is_bot_active(bot['token']) else "🔴"
         if bot['is_blocked']: status = "🚫"
         name = bot['bot_username'] or "Bot"
-        buttons.append([InlineKeyboardButton(f"{status} @{name}", callback_data=f"view_{bot['token'][:10]}")])
+        buttons.append([InlineKeyboardButton(f"{status} @{name}", callback_data=f"view_{bot['bot_id']}")])
     await update.message.reply_text(text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(buttons))
     return MAIN_MENU
 
 async def view_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    prefix = query.data.replace("view_", "")
-    with get_db() as conn:
-        bot = conn.execute("SELECT * FROM bots WHERE token LIKE ?", (f"{prefix}%",)).fetchone()
+    bot_id = parse_bot_id(query.data)
+    bot = await db.get_bot(bot_id) if bot_id else None
     if not bot: return
     
-    status = "🟢 Online" if bot['token'] in ACTIVE_BOTS else "🔴 Offline"
+    status = "🟢 Online" if is_bot_active(bot['token']) else "🔴 Offline"
     if bot['is_blocked']: status = "🚫 Blocked"
     
-    text = f"🤖 <b>@{esc(bot['bot_username'])}</b>\nStatus: {status}\nUpdates: {bot['update_count']}"
+    updates = bot['update_count'] + pending_update_count(bot['token'])
+    text = f"🤖 <b>@{esc(bot['bot_username'])}</b>\nStatus: {status}\nUpdates: {updates}"
     btns = []
     if not bot['is_blocked']:
-        if bot['token'] in ACTIVE_BOTS:
-            btns.append([InlineKeyboardButton("🛑 Stop", callback_data=f"stop_{prefix}"), InlineKeyboardButton("🔄 Restart", callback_data=f"restart_{prefix}")])
+        if is_bot_active(bot['token']):
+            btns.append([InlineKeyboardButton("🛑 Stop", callback_data=f"stop_{bot_id}"), InlineKeyboardButton("🔄 Restart", callback_data=f"restart_{bot_id}")])
         else:
-            btns.append([InlineKeyboardButton("▶️ Start", callback_data=f"start_{prefix}")])
-    btns.append([InlineKeyboardButton("📜 Error Logs", callback_data=f"logs_{prefix}")])
-    btns.append([InlineKeyboardButton("🗑️ Delete", callback_data=f"delete_{prefix}")])
+            btns.append([InlineKeyboardButton("▶️ Start", callback_data=f"start_{bot_id}")])
+    btns.append([InlineKeyboardButton("📜 Error Logs", callback_data=f"logs_{bot_id}")])
+    btns.append([InlineKeyboardButton("🗑️ Delete", callback_data=f"delete_{bot_id}")])
     btns.append([InlineKeyboardButton("🔙 Back", callback_data="back_list")])
     try: await query.edit_message_text(text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(btns))
     except BadRequest: pass
@@ -737,25 +3400,24 @@ async def bot_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.delete_message()
         return
     
-    action, prefix = query.data.split("_", 1)
-    with get_db() as conn:
-        bot = conn.execute("SELECT * FROM bots WHERE token LIKE ?", (f"{prefix}%",)).fetchone()
+    action = query.data.split("_", 1)[0]
+    bot_id = parse_bot_id(query.data)
+    bot = await db.get_bot(bot_id) if bot_id else None
     if not bot: return
     
     token = bot['token']
     if action == "stop": await stop_user_bot(token); msg = "🛑 Stopped."
     elif action == "start": s, _ = await start_user_bot(token, bot['file_path']); msg = "✅ Started." if s else "❌ Error."
-    elif action == "restart": await stop_user_bot(token); await asyncio.sleep(1); await start_user_bot(token, bot['file_path']); msg = "🔄 Restarted."
-    elif action == "delete": await stop_user_bot(token); delete_bot_from_db(token); msg = "🗑️ Deleted."
+    elif action == "restart": s, _ = await reload_user_bot(token, bot['file_path']); msg = "🔄 Restarted." if s else "❌ Error."
+    elif action == "delete": await stop_user_bot(token); await db.delete_bot_from_db(token); discard_analysis(bot['file_path']); msg = "🗑️ Deleted."
     
     await query.answer(msg)
     await view_bot(update, context)
 
 async def view_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    prefix = query.data.replace("logs_", "")
-    with get_db() as conn:
-        bot = conn.execute("SELECT error_log FROM bots WHERE token LIKE ?", (f"{prefix}%",)).fetchone()
+    bot_id = parse_bot_id(query.data)
+    bot = await db.get_bot(bot_id) if bot_id else None
     if bot and bot['error_log']:
         if len(bot['error_log']) > 200:
             bio = BytesIO(bot['error_log'].encode())
@@ -780,13 +3442,64 @@ async def help_send(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    stats = get_stats()
-    text = f"🔐 <b>Admin</b>\nUsers: {stats['users']} | Bots: {stats['total_bots']}\nActive: {len(ACTIVE_BOTS)}"
-    kb = [[InlineKeyboardButton("📜 List Bots", callback_data="admin_list"), InlineKeyboardButton("📢 Broadcast", callback_data="admin_cast")]]
+    stats = await db.get_stats()
+    queues = dispatch_stats()
+    text = (
+        f"🔐 <b>Admin</b>\nUsers: {stats['users']} | Bots: {stats['total_bots']}\nActive: {active_bot_count()} (+{len(DORMANT_BOTS)} dormant)\n"
+        f"Queued: {queues['depth']} | Dropped: {queues['dropped']} | Rejected: {queues['rejected']} | Duplicates: {queues['duplicates']}"
+    )
+    if POLLER:
+        polling = POLLER.stats()
+        text += (
+            f"\nPolling: {polling['bots']} bots, {polling['inflight']}/{polling['limit']} polls in flight, "
+            f"{polling['updates']} updates, {polling['errors']} errors"
+        )
+    text += (
+        f"\nHosted Bot API: {HOSTED_REQUEST_STATS['requests']} requests, "
+        f"{HOSTED_REQUEST_STATS['rate_limited']} 429s, {HOSTED_REQUEST_STATS['retried']} retried"
+    )
+    text += f"\nToken cache: {TOKEN_CACHE.hits} hits / {TOKEN_CACHE.misses} misses / {_token_lookups.coalesced} coalesced"
+    text += (
+        f"\nGemini: {GEMINI_USAGE['calls']} calls, {GEMINI_USAGE['cache_hits']} cached, {_gemini_flights.coalesced} coalesced, "
+        f"{GEMINI_USAGE['prompt_tokens'] + GEMINI_USAGE['output_tokens']} tokens"
+    )
+    for name, call in sorted(OUTBOUND_STATS.items()):
+        text += f"\n{esc(name)}: {call['count']} calls, avg {call['total'] / call['count'] * 1000:.0f}ms"
+    kb = [
+        [InlineKeyboardButton("📜 List Bots", callback_data="admin_list"), InlineKeyboardButton("📢 Broadcast", callback_data="admin_cast")],
+        [InlineKeyboardButton("📈 Broadcast Status", callback_data="admin_bstatus"), InlineKeyboardButton("🧠 Memory", callback_data="admin_mem")],
+        [InlineKeyboardButton("🔬 Profile", callback_data="admin_prof")]
+    ]
     func = update.callback_query.edit_message_text if update.callback_query else update.message.reply_text
     try: await func(text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(kb))
     except BadRequest: pass
 
+async def admin_memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if update.effective_user.id != ADMIN_ID: return
+    await query.answer()
+    shard_pids = [shard.process.pid for shard in WORKER_POOL.shards] if WORKER_POOL else []
+    text = await asyncio.to_thread(memory_report, dict(BOT_MEMORY), shard_pids)
+    kb = [[InlineKeyboardButton("🔙", callback_data="admin_panel")]]
+    try: await query.edit_message_text(text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(kb))
+    except BadRequest: pass
+
+async def admin_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if update.effective_user.id != ADMIN_ID: return
+    if _profile_lock.locked():
+        await query.answer("⏳ A profile is already running.", show_alert=True)
+        return
+    await query.answer(f"🔬 Profiling for {PROFILE_SECONDS:.0f}s...")
+    try: report = await profile_event_loop(PROFILE_SECONDS)
+    except ValueError as e:
+        # Another profiler is already attached to the loop thread
+        await context.bot.send_message(update.effective_chat.id, f"❌ Profiler unavailable: {esc(str(e))}")
+        return
+    bio = BytesIO(report.encode())
+    bio.name = f"profile_{datetime.now():%Y%m%d_%H%M%S}.txt"
+    await context.bot.send_document(update.effective_chat.id, bio)
+
 async def admin_reply_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     context.user_data['reply_target'] = int(update.callback_query.data.split("_")[1])
@@ -801,66 +3514,180 @@ async def admin_reply_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return MAIN_MENU
 
 async def admin_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    bots = get_all_bots_admin()[:20]
+    bots = (await db.get_all_bots_admin())[:20]
     kb = []
     for b in bots:
-        kb.append([InlineKeyboardButton(f"@{b['bot_username']}", callback_data=f"abot_{b['token'][:10]}")])
+        kb.append([InlineKeyboardButton(f"@{b['bot_username']}", callback_data=f"abot_{b['bot_id']}")])
     kb.append([InlineKeyboardButton("🔙", callback_data="admin_panel")])
     await update.callback_query.edit_message_text("📜 <b>Bots</b>", parse_mode='HTML', reply_markup=InlineKeyboardMarkup(kb))
 
 async def admin_bot_view(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    prefix = update.callback_query.data.replace("abot_", "")
-    kb = [[InlineKeyboardButton("Delete", callback_data=f"adel_{prefix}"), InlineKeyboardButton("🔙", callback_data="admin_list")]]
-    await update.callback_query.edit_message_text(f"Bot: {prefix}...", reply_markup=InlineKeyboardMarkup(kb))
+    bot_id = parse_bot_id(update.callback_query.data)
+    bot = await db.get_bot(bot_id) if bot_id else None
+    if not bot: return
+    kb = [[InlineKeyboardButton("Delete", callback_data=f"adel_{bot_id}"), InlineKeyboardButton("🔙", callback_data="admin_list")]]
+    await update.callback_query.edit_message_text(f"Bot: @{esc(bot['bot_username'])} (#{bot_id})", reply_markup=InlineKeyboardMarkup(kb))
 
 async def admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    prefix = update.callback_query.data.split("_")[1]
-    with get_db() as conn:
-        bot = conn.execute("SELECT * FROM bots WHERE token LIKE ?", (f"{prefix}%",)).fetchone()
+    bot_id = parse_bot_id(update.callback_query.data)
+    bot = await db.get_bot(bot_id) if bot_id else None
     if bot:
         await stop_user_bot(bot['token'])
-        delete_bot_from_db(bot['token'])
+        await db.delete_bot_from_db(bot['token'])
+        discard_analysis(bot['file_path'])
     await admin_list(update, context)
 
 async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if CURRENT_BROADCAST:
+        await update.callback_query.answer("A broadcast is already running.", show_alert=True)
+        return
     await update.callback_query.answer()
     await update.callback_query.edit_message_text("📢 Send broadcast msg:")
     return BROADCAST_MSG
 
 async def admin_broadcast_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with get_db() as conn:
-        users = conn.execute("SELECT user_id FROM users").fetchall()
-    for u in users:
-        try: await context.bot.send_message(u[0], update.message.text)
-        except: pass
-    await update.message.reply_text(f"✅ Broadcasted to {len(users)} users.")
+    global CURRENT_BROADCAST, _broadcast_task
+    if CURRENT_BROADCAST:
+        await update.message.reply_text("⏳ A broadcast is already running.")
+        return MAIN_MENU
+    total = await db.count_users()
+    broadcast_id = await db.create_broadcast(update.message.text, total)
+    msg = await update.message.reply_text(f"📢 Broadcast #{broadcast_id} queued for {total} users...")
+    CURRENT_BROADCAST = BroadcastJob(broadcast_id, update.message.text, context.bot, total, msg.chat_id, msg.message_id)
+    _broadcast_task = asyncio.create_task(CURRENT_BROADCAST.run())
     return MAIN_MENU
 
+async def admin_broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    text = CURRENT_BROADCAST.summary() if CURRENT_BROADCAST else (LAST_BROADCAST_SUMMARY or "No broadcasts yet.")
+    await query.answer(text[:200], show_alert=True)
+
 async def webhook_handler(request):
     token = request.match_info.get('token')
     try:
         data = await request.json()
-        if token == PLATFORM_BOT_TOKEN and platform_app:
-            await platform_app.process_update(Update.de_json(data, platform_app.bot))
-        elif token in ACTIVE_BOTS:
-            increment_bot_update_count(token)
-            await ACTIVE_BOTS[token].process_update(Update.de_json(data, ACTIVE_BOTS[token].bot))
-        return web.Response(text="OK")
     except Exception as e:
         logger.error(f"Webhook Error: {e}")
         return web.Response(status=400)
+    if not isinstance(data, dict):
+        return web.Response(status=400)
+    if ingest_update(token, data) is False:
+        # Queue full: let Telegram redeliver later instead of holding the request
+        return web.Response(status=503)
+    return web.Response(text="OK")
+
+def ingest_update(token: str, data: dict) -> Optional[bool]:
+    # Shared by webhook_handler and the poll multiplexer. Returns None for an
+    # unknown token, False when the update was refused and must be redelivered
+    dispatcher = DISPATCHERS.get(token)
+    shard = REMOTE_BOTS.get(token)
+    if dispatcher is None and token in DORMANT_BOTS:
+        dispatcher = activate_dormant_bot(token)
+    if not (dispatcher or shard):
+        # Still waiting for its restore slot: Telegram retries until it is up
+        return False if token in RESTORING_BOTS else None
+    # Redeliveries are acknowledged without reaching the bot again
+    update_id = data.get("update_id")
+    window = update_window(token) if isinstance(update_id, int) else None
+    if window and window.is_duplicate(update_id):
+        return True
+    if not (dispatcher.submit(data) if dispatcher else shard.route(token, data)):
+        return False
+    if window:
+        window.add(update_id)
+    if token != PLATFORM_BOT_TOKEN:
+        increment_bot_update_count(token)
+    return True
+
+async def register_restores():
+    # Runs before the server listens so no webhook for a known bot is dropped
+    bots = [(t, p) for t, p, b in await db.get_all_running_bots() if not b and os.path.exists(p)]
+    if LAZY_ACTIVATION and WORKER_POOL is None:
+        # Webhooks are still registered from the previous run; load on first update
+        DORMANT_BOTS.update(bots)
+        logger.info(f"Registered {len(bots)} bots for on-demand activation")
+    else:
+        RESTORING_BOTS.update(bots)
 
 async def restore_bots():
-    bots = get_all_running_bots()
-    logger.info(f"Restoring {len(bots)} bots...")
-    for t, p, b in bots:
-        if not b and os.path.exists(p): await start_user_bot(t, p)
+    if POLLER:
+        for token in DORMANT_BOTS:
+            POLLER.add(token)
+    bots = list(RESTORING_BOTS.items())
+    total = len(bots)
+    if not total:
+        return
+    logger.info(f"Restoring {total} bots (concurrency {RESTORE_CONCURRENCY}, {RESTORE_RATE}/s)...")
+    slots = asyncio.Semaphore(RESTORE_CONCURRENCY)
+    limiter = RateLimiter(RESTORE_RATE, burst=RESTORE_CONCURRENCY)
+    started = time.perf_counter()
+    done = 0
+
+    async def restore_one(token: str, file_path: str) -> bool:
+        nonlocal done
+        async with slots:
+            if token not in RESTORING_BOTS:
+                return False  # stopped or deleted before its turn
+            # Each start costs a getMe + setWebhook round trip against the Bot API
+            await limiter.acquire()
+            t0 = time.perf_counter()
+            try:
+                success, msg = await start_user_bot(token, file_path)
+            finally:
+                RESTORING_BOTS.pop(token, None)
+            done += 1
+            result = "ok" if success else f"failed: {msg}"
+            logger.info(f"Restore [{done}/{total}] {token[:15]}... {result} ({time.perf_counter() - t0:.2f}s)")
+            return success
+
+    results = await asyncio.gather(*(restore_one(t, p) for t, p in bots))
+    logger.info(f"Restored {sum(results)}/{total} bots in {time.perf_counter() - started:.1f}s")
+
+async def shutdown_platform():
+    global WORKER_POOL
+    logger.info("Shutting down...")
+    if _broadcast_task and not _broadcast_task.done():
+        _broadcast_task.cancel()
+        await asyncio.gather(_broadcast_task, return_exceptions=True)
+    if POLLER:
+        await POLLER.stop()
+    if WORKER_POOL is not None:
+        await WORKER_POOL.stop()
+        WORKER_POOL = None
+        REMOTE_BOTS.clear()
+    for token in list(DISPATCHERS):
+        await stop_dispatcher(token, STOP_DRAIN_TIMEOUT)
+    for token in list(ACTIVE_BOTS):
+        await unload_user_app(ACTIVE_BOTS.pop(token), BOT_MODULES.pop(token, None))
+        BOT_MEMORY.pop(token, None)
+    try:
+        await flush_update_counts()
+    except Exception as e:
+        logger.error(f"Final update count flush failed: {e}")
+    await stop_persistence()
+    if platform_app:
+        await platform_app.stop()
+        await platform_app.shutdown()
+    await close_http_session()
+    await close_bot_api_session()
+    db.close()
+
+def build_web_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post('/bot/{token}', webhook_handler)
+    app.router.add_get('/', lambda r: web.Response(text="Running"))
+    app.router.add_get('/metrics', metrics_handler)
+    return app
 
 def main():
     global platform_app
+    start_memory_tracing()
     init_db()
     req = HTTPXRequest(connection_pool_size=20)
-    platform_app = Application.builder().token(PLATFORM_BOT_TOKEN).request(req).build()
+    platform_app = (
+        Application.builder().token(PLATFORM_BOT_TOKEN).request(req)
+        .base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot").build()
+    )
     
     conv = ConversationHandler(
         entry_points=[
@@ -886,6 +3713,9 @@ def main():
     platform_app.add_handler(CallbackQueryHandler(admin_panel, pattern="^admin_panel"))
     platform_app.add_handler(CallbackQueryHandler(admin_list, pattern="^admin_list"))
     platform_app.add_handler(CallbackQueryHandler(admin_broadcast_start, pattern="^admin_cast"))
+    platform_app.add_handler(CallbackQueryHandler(admin_broadcast_status, pattern="^admin_bstatus"))
+    platform_app.add_handler(CallbackQueryHandler(admin_memory, pattern="^admin_mem"))
+    platform_app.add_handler(CallbackQueryHandler(admin_profile, pattern="^admin_prof"))
     platform_app.add_handler(CallbackQueryHandler(admin_bot_view, pattern="^abot_"))
     platform_app.add_handler(CallbackQueryHandler(admin_action, pattern="^(ablock|adel)_"))
     platform_app.add_handler(CallbackQueryHandler(view_bot, pattern="^view_"))
@@ -893,26 +3723,56 @@ def main():
     platform_app.add_handler(CallbackQueryHandler(bot_action, pattern="^(stop|start|restart|delete|back)_"))
     platform_app.add_handler(CallbackQueryHandler(admin_reply_start, pattern="^reply_"))
     
-    app = web.Application()
-    app.router.add_post('/bot/{token}', webhook_handler)
-    app.router.add_get('/', lambda r: web.Response(text="Running"))
+    app = build_web_app()
     
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     
     async def runner():
+        global WORKER_POOL, POLLER
+        get_http_session()
         await platform_app.initialize()
         await platform_app.start()
-        # SET PLATFORM WEBHOOK
-        url = f"{RENDER_EXTERNAL_URL}/bot/{PLATFORM_BOT_TOKEN}"
-        logger.info(f"Setting Platform Webhook: {url}")
-        await platform_app.bot.set_webhook(url)
-        await restore_bots()
+        start_dispatcher(PLATFORM_BOT_TOKEN, platform_app, PLATFORM_UPDATE_WORKERS, scheduled=False)
+        if EXECUTION_MODE == "process":
+            WORKER_POOL = WorkerPool(WORKER_PROCESSES)
+            await WORKER_POOL.start()
         
+        await register_restores()
+        # Listen before restoring; updates for bots still queued get 503 and are redelivered
         server = web.AppRunner(app)
         await server.setup()
         await web.TCPSite(server, '0.0.0.0', int(os.environ.get("PORT", 8080))).start()
-        await asyncio.Event().wait()
+        
+        if INGESTION_MODE == "polling":
+            await platform_app.bot.delete_webhook()
+            POLLER = PollMultiplexer()
+            POLLER.start()
+            POLLER.add(PLATFORM_BOT_TOKEN)
+            logger.info("Ingesting updates by long polling")
+        else:
+            # SET PLATFORM WEBHOOK
+            url = f"{RENDER_EXTERNAL_URL}/bot/{PLATFORM_BOT_TOKEN}"
+            logger.info(f"Setting Platform Webhook: {url}")
+            await platform_app.bot.set_webhook(url)
+        restorer = asyncio.create_task(restore_bots())
+        flusher = asyncio.create_task(update_count_flusher())
+        evictor = asyncio.create_task(idle_evictor()) if LAZY_ACTIVATION and WORKER_POOL is None else None
+        lag_monitor = asyncio.create_task(loop_lag_monitor())
+        
+        stop_event = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try: loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError: pass
+        try:
+            await stop_event.wait()
+        finally:
+            restorer.cancel()
+            flusher.cancel()
+            if evictor: evictor.cancel()
+            lag_monitor.cancel()
+            await server.cleanup()
+            await shutdown_platform()
         
     try: loop.run_until_complete(runner())
     except KeyboardInterrupt: pass
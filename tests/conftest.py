@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def workdir(tmp_path_factory):
+    # main keeps the DB, bot files and analysis cache at relative paths, and
+    # DB connections are per thread for the life of the process, so every
+    # test shares one directory and database
+    path = tmp_path_factory.mktemp("platform")
+    cwd = os.getcwd()
+    os.chdir(path)
+    os.makedirs(main.BOTS_DIR)
+    main.init_db()
+    yield path
+    os.chdir(cwd)
@@ -0,0 +1,88 @@
+import asyncio
+import sys
+import threading
+
+import main
+
+
+def test_ttlcache_concurrent_access():
+    # Switch threads as often as possible so unlocked get/set/evict interleave
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    cache = main.TTLCache(4)
+    errors = []
+
+    def hammer(offset):
+        try:
+            for i in range(50000):
+                key = (offset + i) % 8
+                # Entries expiring right away make get() delete them as well
+                cache.set(key, i, 0 if i % 2 else 60)
+                cache.get((key + 1) % 8)
+                cache.get(key)
+                if i % 3 == 0:
+                    cache.pop((key + 2) % 8)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=hammer, args=(n * 5,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert errors == []
+    assert len(cache) <= 4
+
+
+def test_ttlcache_expiry_and_lru():
+    cache = main.TTLCache(2)
+    cache.set("a", 1, 60)
+    cache.set("b", 2, 60)
+    cache.get("a")
+    cache.set("c", 3, 60)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    cache.set("d", 4, -1)
+    assert cache.get("d") is None
+
+
+def test_analyze_file_from_threads(workdir, monkeypatch):
+    monkeypatch.setattr(main, "_ANALYSIS_MEMO", main.TTLCache(4))
+    paths = []
+    for i in range(40):
+        path = f"user_bots/bot{i}.py"
+        with open(path, "w") as f:
+            f.write(f"import json\napplication = {i}\n")
+        paths.append(path)
+
+    async def run():
+        return await asyncio.gather(*(asyncio.to_thread(main.analyze_file, p) for p in paths * 3))
+
+    results = asyncio.run(run())
+    assert all(r.valid and r.imports == frozenset({"json"}) for r in results)
+
+
+def test_singleflight_survives_first_caller_cancel():
+    calls = []
+
+    async def run():
+        flight = main.SingleFlight()
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 42
+
+        first = asyncio.create_task(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(flight.do("k", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, flight
+
+    result, flight = asyncio.run(run())
+    assert result == 42 and calls == [1]
+    assert flight.coalesced == 1 and not flight._inflight
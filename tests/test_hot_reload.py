@@ -0,0 +1,86 @@
+import asyncio
+import os
+import sys
+
+import bench_load
+import main
+
+
+def write_bot(token: str, base_url: str) -> str:
+    path = os.path.join(main.BOTS_DIR, f"reload_{token.split(':')[0]}.py")
+    with open(path, "w") as f:
+        f.write(bench_load.BOT_TEMPLATE.format(token=token, base_url=f"{base_url}/bot"))
+    return path
+
+
+def run_with_fake_api(body):
+    async def run():
+        fake = bench_load.FakeTelegram()
+        port = bench_load.free_port()
+        runner = await fake.start(port)
+        try:
+            await body(f"http://127.0.0.1:{port}")
+        finally:
+            await main.stop_persistence()
+            await main.close_bot_api_session()
+            await main.close_http_session()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_concurrent_reloads_leave_one_live_app(workdir, monkeypatch):
+    token = "7100001:RELOAD"
+    loaded = []
+    load_user_app = main.load_user_app
+
+    async def tracking_load(*args):
+        app, module_name = await load_user_app(*args)
+        loaded.append((app, module_name))
+        return app, module_name
+
+    monkeypatch.setattr(main, "load_user_app", tracking_load)
+
+    async def body(base_url):
+        path = write_bot(token, base_url)
+        assert (await main.start_user_bot(token, path))[0]
+        results = await asyncio.gather(
+            *(main.reload_user_bot(token, path) for _ in range(3)),
+            main.start_user_bot(token, path),
+        )
+        assert all(ok for ok, _ in results)
+        assert [app for app, _ in loaded if app.running] == [main.ACTIVE_BOTS[token]]
+        assert [name for _, name in loaded if name in sys.modules] == [main.BOT_MODULES[token]]
+        assert main.DISPATCHERS[token]._resume.is_set()
+        assert (await main.stop_user_bot(token))[0]
+        assert not any(app.running for app, _ in loaded)
+
+    run_with_fake_api(body)
+
+
+def test_cancelled_reload_resumes_dispatcher(workdir, monkeypatch):
+    token = "7100002:RELOAD"
+
+    async def body(base_url):
+        path = write_bot(token, base_url)
+        assert (await main.start_user_bot(token, path))[0]
+        app = main.ACTIVE_BOTS[token]
+        dispatcher = main.DISPATCHERS[token]
+        loading = asyncio.Event()
+
+        async def hanging_load(*args):
+            loading.set()
+            await asyncio.sleep(3600)
+
+        monkeypatch.setattr(main, "load_user_app", hanging_load)
+        reload = asyncio.create_task(main.reload_user_bot(token, path))
+        await asyncio.wait_for(loading.wait(), 10)
+        assert not dispatcher._resume.is_set()
+        reload.cancel()
+        await asyncio.gather(reload, return_exceptions=True)
+        assert dispatcher._resume.is_set()
+        assert main.ACTIVE_BOTS[token] is app
+        monkeypatch.undo()
+        assert (await main.stop_user_bot(token))[0]
+
+    run_with_fake_api(body)
@@ -0,0 +1,39 @@
+import asyncio
+
+import bench_load
+import main
+from test_hot_reload import run_with_fake_api, write_bot
+
+
+def test_process_mode_exports_per_bot_series(workdir, monkeypatch):
+    token = "7100003:METRICS"
+
+    async def body(base_url):
+        monkeypatch.setattr(main, "WORKER_POOL", main.WorkerPool(1))
+        await main.WORKER_POOL.start()
+        try:
+            path = write_bot(token, base_url)
+            assert (await main.start_user_bot(token, path))[0]
+            for seq in range(1, 6):
+                assert main.ingest_update(token, bench_load.make_update(seq))
+            for _ in range(100):
+                text = main.render_metrics(await main.WORKER_POOL.metrics())
+                if 'hostkaro_bot_updates_total{bot="7100003",result="processed"} 5' in text:
+                    break
+                await asyncio.sleep(0.05)
+            assert 'hostkaro_bot_updates_total{bot="7100003",result="processed"} 5' in text
+            assert 'hostkaro_handler_seconds_count{bot="7100003"} 5' in text
+            assert 'hostkaro_duplicate_updates_total{bot="7100003"} 0' in text
+            assert (await main.stop_user_bot(token))[0]
+        finally:
+            await main.WORKER_POOL.stop()
+            main.REMOTE_BOTS.clear()
+
+    run_with_fake_api(body)
+
+
+def test_histograms_merge_across_processes():
+    snapshot = {"bots": {}, "duplicates": {"1": 2}, "handler": {"1": [[1] + [0] * 10, 0.5, 1]}}
+    bots, duplicates, handler = main._merge_bot_metrics([snapshot, snapshot])
+    assert duplicates == {"1": 4}
+    assert handler["1"].counts[0] == 2 and handler["1"].count == 2 and handler["1"].sum == 1.0
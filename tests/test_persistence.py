@@ -0,0 +1,86 @@
+import asyncio
+import os
+import sqlite3
+
+import bench_load
+import main
+from test_hot_reload import run_with_fake_api
+
+SEEDED_BOT = '''
+from telegram.ext import Application, MessageHandler, filters
+
+async def count(update, context):
+    context.bot_data["seen"] = context.bot_data.get("seen", 0) + 1
+    context.user_data["callback"] = lambda: None  # deep-copyable, not picklable
+    context.user_data["n"] = context.user_data.get("n", 0) + 1
+    await update.message.reply_text("ok")
+
+application = Application.builder().token({token!r}).base_url({base_url!r}).build()
+application.bot_data["greeting"] = "hi"
+application.add_handler(MessageHandler(filters.TEXT, count))
+'''
+
+
+def write(name: str, source: str) -> str:
+    path = os.path.join(main.BOTS_DIR, name)
+    with open(path, "w") as f:
+        f.write(source)
+    return path
+
+
+def test_seeded_bot_data_round_trip(workdir, monkeypatch):
+    monkeypatch.setattr(main, "BOT_PERSISTENCE", True)
+    token = "7100004:PERSIST"
+
+    async def body(base_url):
+        path = write("seeded.py", SEEDED_BOT.format(token=token, base_url=f"{base_url}/bot"))
+        assert (await main.start_user_bot(token, path))[0]
+        app = main.ACTIVE_BOTS[token]
+        assert app.bot_data == {"greeting": "hi"}
+        assert app.persistence._rows is None
+        main.DISPATCHERS[token].submit(bench_load.make_update(1))
+        await main.DISPATCHERS[token].queue.join()
+        assert (await main.stop_user_bot(token))[0]
+        stored = {(r["kind"], r["key"]) for r in main.load_bot_state(7100004)}
+        assert ("bot", "") in stored and ("user", "1") not in stored
+
+        assert (await main.start_user_bot(token, path))[0]
+        app = main.ACTIVE_BOTS[token]
+        assert app.bot_data == {"greeting": "hi", "seen": 1}
+        assert (await main.stop_user_bot(token))[0]
+
+    run_with_fake_api(body)
+
+
+def test_custom_bot_data_type_without_stored_state(workdir, monkeypatch):
+    monkeypatch.setattr(main, "BOT_PERSISTENCE", True)
+    token = "7100005:PERSIST"
+
+    async def body(base_url):
+        path = write("custom.py", bench_load.BOT_TEMPLATE.format(token=token, base_url=f"{base_url}/bot"))
+        assert (await main.start_user_bot(token, path))[0]
+        assert type(main.ACTIVE_BOTS[token].bot_data).__name__ == "BotData"
+        assert (await main.stop_user_bot(token))[0]
+
+    run_with_fake_api(body)
+
+
+def test_unpicklable_key_is_skipped():
+    persistence = main.PlatformPersistence(7100006)
+    asyncio.run(persistence.update_user_data(1, {"callback": lambda: None}))
+    asyncio.run(persistence.update_user_data(2, {"n": 1}))
+    assert (7100006, "user", "1") not in main.PERSISTENCE_DIRTY
+    assert main.PERSISTENCE_DIRTY.pop((7100006, "user", "2")) is not None
+
+
+def test_bot_persistence_column_renamed(tmp_path, monkeypatch):
+    path = str(tmp_path / "old.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE bot_persistence (bot_id INTEGER, kind TEXT, key TEXT, data BLOB, "
+                     "PRIMARY KEY (bot_id, kind, key)) WITHOUT ROWID")
+        conn.execute("INSERT INTO bot_persistence VALUES (5, 'bot', '', x'00')")
+    monkeypatch.setattr(main, "DB_FILE", path)
+    # A fresh thread gets its own connection to the patched DB_FILE
+    asyncio.run(asyncio.to_thread(main.init_db))
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT tg_bot_id FROM bot_persistence").fetchall() == [(5,)]